@@ -0,0 +1,3 @@
+"""
+Benchmarks for the compendium tools, see benchmarks/suite.py (run with python -m benchmarks.suite)
+"""
@@ -0,0 +1,99 @@
+"""
+Benchmark the start-up time of the compendium command line
+
+Runs each command a number of times in a fresh python process and reports the median wall time. With
+python -X importtime, it also reports the slowest imports, and which heavy dependencies (cryptography, doit,
+requests) were loaded although the command does not need them. Exits with an error if the median time of a
+command exceeds --max-ms or a command loads a heavy dependency it should not load, so it can be used in CI to
+catch start-up regressions.
+
+Usage: python benchmarks/startup.py [--repeat 10] [--max-ms 200] [--json results.json]
+"""
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# (name, python arguments, heavy modules the command should not import)
+COMMANDS = [
+    ("help", ["-m", "compendium", "--help"], ["cryptography", "doit", "requests"]),
+    ("check", ["-m", "compendium", "check"], ["cryptography", "doit", "requests"]),
+    ("stats", ["-m", "compendium", "stats"], ["cryptography", "doit", "requests"]),
+    ("import compendium", ["-c", "import compendium.compendium"], ["cryptography", "doit", "requests"]),
+]
+
+_IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def run(args: List[str], cwd: Path) -> float:
+    """Run python with the given arguments, returning the wall time in seconds"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def import_times(args: List[str], cwd: Path) -> Dict[str, int]:
+    """Get the cumulative import time (in microseconds) of each module loaded by python with the given arguments"""
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=cwd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+    result = {}
+    for line in proc.stderr.splitlines():
+        m = _IMPORTTIME.match(line)
+        if m:
+            result[m.group(4)] = int(m.group(2))
+    return result
+
+
+def benchmark(folder: Path, repeat: int, top: int) -> List[dict]:
+    results = []
+    for name, args, heavy in COMMANDS:
+        run(args, folder)  # warm up the file system cache, so we measure a warm start of a cold interpreter
+        times = [run(args, folder) for _ in range(repeat)]
+        imports = import_times(args, folder)
+        slowest: List[Tuple[str, int]] = sorted(((m, t) for (m, t) in imports.items() if "." not in m),
+                                                key=lambda x: x[1], reverse=True)[:top]
+        results.append(dict(command=name, median_ms=round(statistics.median(times) * 1000, 1),
+                            min_ms=round(min(times) * 1000, 1), modules=len(imports),
+                            heavy=[module for module in heavy if module in imports],
+                            slowest_imports={m: round(t / 1000, 1) for (m, t) in slowest}))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", "-n", type=int, default=10, help="Number of runs per command (default: 10)")
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest imports to report (default: 5)")
+    parser.add_argument("--max-ms", type=float, help="Fail if the median time of a command exceeds this")
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = Path(tmp)
+        (folder / ".compendium.cfg").write_text("[encryption]\nsalt = benchmark\n")
+        results = benchmark(folder, args.repeat, args.top)
+
+    ok = True
+    for r in results:
+        slowest = ", ".join(f"{m} {t:.0f}ms" for (m, t) in r["slowest_imports"].items())
+        print(f"{r['command']:<20} {r['median_ms']:>7.1f}ms (min {r['min_ms']:.1f}ms), {r['modules']} modules; "
+              f"slowest imports: {slowest}")
+        if r["heavy"]:
+            print(f"  ERROR: {r['command']} imports {', '.join(r['heavy'])}", file=sys.stderr)
+            ok = False
+        if args.max_ms is not None and r["median_ms"] > args.max_ms:
+            print(f"  ERROR: {r['command']} takes more than {args.max_ms}ms", file=sys.stderr)
+            ok = False
+    if args.json:
+        with args.json.open("w") as f:
+            json.dump(dict(python=sys.version.split()[0], time=time.time(), results=results), f, indent=1)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Benchmark suite for the compendium tools
+
+Generates synthetic compendia (see benchmarks/synthetic.py) for every combination of --scripts and --shapes,
+and times:
+ - headers: parsing the headers of all scripts, without (cold) and with (indexed) the header index
+ - actions: getting the actions from the task index, as doit does if nothing changed
+ - check: the consistency check of the dependency graph, and finding cycles (get_cycles) only
+ - tasks: generating the doit tasks of templates/dodo.py (if doit is installed)
+ - cli: running compendium check in a new process
+It also times deriving the key, and encrypting and decrypting --private files of --private-size, sequentially and
+with a process per CPU.
+
+Results are printed, and written as JSON with --json. With --compare, the results are compared with an earlier
+JSON file (e.g. of the previous release), and the suite fails if a benchmark became more than --tolerance slower.
+
+Usage: python -m benchmarks.suite [--scripts 100 2000] [--shapes chain diamond] [--json results.json]
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from benchmarks.startup import run as run_python
+from benchmarks.synthetic import Spec, SHAPES, generate
+from compendium.command.check import do_check, get_cycles
+from compendium.compendium import Compendium, _get_compendium
+from compendium.util import parse_size, format_size
+
+ROOT = Path(__file__).parent.parent
+DODO = ROOT / "templates" / "dodo.py"
+
+
+def measure(function: Callable[[], object], repeat: int, setup: Callable[[], object] = None) -> List[float]:
+    """Call function repeat times (calling setup before each call, untimed), returning the times in seconds"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name: str, params: dict, times: List[float], nbytes: int = None) -> dict:
+    r = dict(benchmark=name, params=params, n=len(times), median_s=statistics.median(times), min_s=min(times))
+    if nbytes is not None:
+        r["mb_per_s"] = nbytes / 1024 ** 2 / r["median_s"]
+    return r
+
+
+def _load_dodo():
+    """Load templates/dodo.py as a module, or return None if doit is not installed"""
+    spec = importlib.util.spec_from_file_location("_benchmark_dodo", DODO)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as e:
+        logging.warning(f"Skipping the tasks benchmark: {e}")
+        return None
+    return module
+
+
+def bench_graph(folder: Path, spec: Spec, repeat: int, dodo) -> List[dict]:
+    """Benchmark parsing, checking and task generation on a synthetic compendium"""
+    generate(folder, spec)
+    params = dict(scripts=spec.scripts, shape=spec.shape)
+    state = folder / ".compendium"
+    results = []
+
+    def _clear_state():
+        shutil.rmtree(state, ignore_errors=True)
+
+    def _clear_tasks():
+        try:
+            (state / "tasks.json").unlink()
+        except FileNotFoundError:
+            pass
+
+    results.append(result("headers/cold", params, measure(lambda: list(Compendium(folder)._parse_actions()),
+                                                          repeat, setup=_clear_state)))
+    results.append(result("headers/indexed", params, measure(lambda: list(Compendium(folder)._parse_actions()),
+                                                             repeat, setup=_clear_tasks)))
+    Compendium(folder).get_actions()  # create the task index
+    results.append(result("actions/cached", params, measure(lambda: Compendium(folder).get_actions(), repeat)))
+
+    compendium = Compendium(folder)
+    errors = do_check(compendium)
+    if errors:
+        raise ValueError(f"Synthetic compendium is not consistent: {errors[:3]}")
+    results.append(result("check/graph", params, measure(lambda: do_check(compendium), repeat)))
+    graph = defaultdict(set)
+    for action in compendium.get_actions():
+        for input in action.inputs:
+            graph[input].update(action.targets)
+    results.append(result("check/cycles", params, measure(lambda: list(get_cycles(graph)), repeat)))
+
+    if dodo is not None:
+        def _tasks():
+            _get_compendium.cache_clear()
+            for task in dodo.task_install, dodo.task_decrypt, dodo.task_process:
+                list(task())
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            results.append(result("tasks/cached", params, measure(_tasks, repeat)))
+        finally:
+            os.chdir(cwd)
+
+    results.append(result("cli/check", params,
+                          [run_python(["-m", "compendium", "check"], folder) for _ in range(repeat)]))
+    return results
+
+
+def bench_crypto(folder: Path, spec: Spec, repeat: int) -> List[dict]:
+    """Benchmark key derivation and bulk encryption and decryption of the private files"""
+    from compendium.encryption import KDF, derive_key, encrypt_file, decrypt_file, map_files
+    folders = generate(folder, spec)
+    params = dict(files=spec.private, size=spec.private_size)
+    results = [result("crypto/derive_key", dict(kdf=str(KDF())),
+                      measure(lambda: derive_key("synthetic", "password"), repeat))]
+    key = Compendium(folder).get_key("password")
+    private = sorted(folders.DATA_PRIVATE.iterdir())
+    encrypted = [folders.DATA_ENCRYPTED / f.name for f in private]
+    decrypted = [folder / "decrypted" / f.name for f in private]
+    folders.DATA_ENCRYPTED.mkdir(exist_ok=True)
+    decrypted[0].parent.mkdir(exist_ok=True)
+    nbytes = spec.private * spec.private_size
+    for jobs in sorted({1, os.cpu_count() or 1}):
+        p = dict(params, jobs=jobs)
+        results.append(result("crypto/encrypt", p, measure(
+            lambda: list(map_files(encrypt_file, key, list(zip(private, encrypted)), jobs)), repeat), nbytes))
+        results.append(result("crypto/decrypt", p, measure(
+            lambda: list(map_files(decrypt_file, key, list(zip(encrypted, decrypted)), jobs)), repeat), nbytes))
+    return results
+
+
+def compare(results: List[dict], baseline: dict, tolerance: float) -> bool:
+    """Print the change of each benchmark compared to the baseline, returning False if any exceeds tolerance"""
+    def _key(r: dict) -> str:
+        return f"{r['benchmark']} {json.dumps(r['params'], sort_keys=True)}"
+    before = {_key(r): r for r in baseline["results"]}
+    ok = True
+    print(f"\nCompared to {baseline.get('commit') or 'baseline'}:")
+    for r in results:
+        old = before.get(_key(r))
+        if not old:
+            continue
+        ratio = r["median_s"] / old["median_s"]
+        slower = ratio > tolerance
+        ok = ok and not slower
+        print(f"{'SLOWER' if slower else '':<7}{_key(r):<60} {old['median_s'] * 1000:9.1f}ms -> "
+              f"{r['median_s'] * 1000:9.1f}ms ({ratio:.2f}x)")
+    return ok
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scripts", type=int, nargs="+", default=[100, 1000], help="Numbers of scripts")
+    parser.add_argument("--shapes", nargs="+", choices=list(SHAPES), default=["chain", "fanout", "diamond"],
+                        help="Shapes of the dependency graph")
+    parser.add_argument("--private", type=int, default=8, help="Number of private files to encrypt (0 to skip)")
+    parser.add_argument("--private-size", type=parse_size, default=parse_size("8M"),
+                        help="Size of each private file (default: 8M)")
+    parser.add_argument("--repeat", "-n", type=int, default=5, help="Number of runs per benchmark (default: 5)")
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    parser.add_argument("--compare", type=Path, help="Compare the results with this (earlier) results file")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Fail if a benchmark is this many times slower than in --compare (default: 1.25)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='[%(levelname)-5s] %(message)s')
+
+    dodo = _load_dodo()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="compendium-benchmark-") as tmp:
+        for scripts in args.scripts:
+            for shape in args.shapes:
+                folder = Path(tmp) / f"{shape}-{scripts}"
+                folder.mkdir()
+                results += bench_graph(folder, Spec(scripts=scripts, shape=shape), args.repeat, dodo)
+        if args.private:
+            folder = Path(tmp) / "crypto"
+            folder.mkdir()
+            spec = Spec(scripts=0, private=args.private, private_size=args.private_size)
+            results += bench_crypto(folder, spec, args.repeat)
+        results.append(result("cli/help", {}, [run_python(["-m", "compendium", "--help"], Path(tmp))
+                                               for _ in range(args.repeat)]))
+
+    for r in results:
+        params = " ".join(f"{k}={format_size(v) if k == 'size' else v}" for (k, v) in r["params"].items())
+        throughput = f" {r['mb_per_s']:8.1f} MB/s" if "mb_per_s" in r else ""
+        print(f"{r['benchmark']:<18} {params:<32} {r['median_s'] * 1000:10.2f}ms (min {r['min_s'] * 1000:.2f}ms)"
+              f"{throughput}")
+    if args.json:
+        with args.json.open("w") as f:
+            json.dump(dict(commit=_commit(), python=sys.version.split()[0], platform=platform.platform(),
+                           cpus=os.cpu_count(), time=time.time(), results=results), f, indent=1)
+    if args.compare:
+        with args.compare.open() as f:
+            if not compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
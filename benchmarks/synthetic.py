@@ -0,0 +1,138 @@
+"""
+Generate synthetic compendia for benchmarking
+
+A synthetic compendium has a number of processing scripts (in subfolders of src/data-processing) whose
+dependencies form a DAG of the given shape, raw data files of the given size, and private files (which can be
+encrypted with compendium encrypt). The scripts only have headers and a trivial body; they are meant to be parsed
+and checked, not run.
+
+Shapes:
+ - chain: every script depends on the output of the previous script
+ - fanout: one script creates a file that all other scripts depend on
+ - diamond: repeated diamonds, a -> (b, c) -> d, where each a depends on the d of the previous diamond
+ - random: every script depends on 1-3 outputs of earlier scripts or raw files (reproducible with --seed)
+
+Usage: python -m benchmarks.synthetic FOLDER [--scripts 2000] [--shape diamond] [--raw 10] [--private 10]
+"""
+import argparse
+import os
+import random
+from pathlib import Path
+from typing import List, NamedTuple, Callable, Dict
+
+from compendium.compendium import CONFIGFILE, Folders
+from compendium.util import parse_size
+
+SCRIPTS_PER_FOLDER = 50
+
+_SCRIPT = """#!/usr/bin/env python3
+#TITLE: Synthetic script {i}
+#DESCRIPTION: Synthetic script {i} of a {shape} compendium
+#CREATES: {target}
+#DEPENDS: {inputs}
+
+import sys
+print("This script is only parsed by the benchmarks", file=sys.stderr)
+"""
+
+
+class Spec(NamedTuple):
+    scripts: int = 100
+    shape: str = "chain"
+    raw: int = 10  # number of raw data files
+    raw_size: int = 1024
+    private: int = 0  # number of private files
+    private_size: int = 1024 * 1024
+    seed: int = 42
+
+
+def _chain(i: int, targets: List[str], raw: List[str], rnd: random.Random) -> List[str]:
+    return [targets[i - 1]] if i else [raw[0]]
+
+
+def _fanout(i: int, targets: List[str], raw: List[str], rnd: random.Random) -> List[str]:
+    return [targets[0]] if i else raw
+
+
+def _diamond(i: int, targets: List[str], raw: List[str], rnd: random.Random) -> List[str]:
+    position, start = i % 4, i - i % 4
+    if position == 0:
+        return [targets[i - 1]] if i else [raw[0]]
+    if position == 3:
+        return [targets[start + 1], targets[start + 2]]
+    return [targets[start]]
+
+
+def _random(i: int, targets: List[str], raw: List[str], rnd: random.Random) -> List[str]:
+    candidates = targets[:i] + raw
+    return sorted(set(rnd.choices(candidates, k=rnd.randint(1, 3))))
+
+
+SHAPES: Dict[str, Callable[[int, List[str], List[str], random.Random], List[str]]] = {
+    "chain": _chain,
+    "fanout": _fanout,
+    "diamond": _diamond,
+    "random": _random,
+}
+
+
+def _write_data(file: Path, size: int, rnd: random.Random):
+    """Write size bytes of csv-like (somewhat compressible) data"""
+    file.parent.mkdir(parents=True, exist_ok=True)
+    line = ",".join(str(rnd.randint(0, 10 ** 6)) for _ in range(8)) + "\n"
+    with file.open("w") as f:
+        for _ in range(size // len(line)):
+            f.write(line)
+        f.write("x" * (size % len(line)))
+
+
+def generate(folder: Path, spec: Spec) -> Folders:
+    """Create a synthetic compendium in folder, which should not contain a compendium yet"""
+    if spec.shape not in SHAPES:
+        raise ValueError(f"Unknown shape {spec.shape}, use one of {', '.join(SHAPES)}")
+    if (folder / CONFIGFILE).exists():
+        raise ValueError(f"{folder} already contains a compendium")
+    folders = Folders(folder)
+    for f in folders.DATA_RAW, folders.DATA_PRIVATE, folders.DATA_INTERMEDIATE, folders.SRC_ANALYSIS:
+        f.mkdir(parents=True, exist_ok=True)
+    # use the cheapest key derivation, so the benchmarks measure the encryption rather than deriving the key
+    (folder / CONFIGFILE).write_text("# Compendium configuration file\n[encryption]\nsalt = synthetic\n"
+                                     "kdf = pbkdf2 iterations=1000\n")
+    rnd = random.Random(spec.seed)
+    raw = []
+    for i in range(max(spec.raw, 1)):
+        file = folders.DATA_RAW / f"input{i:04d}.csv"
+        _write_data(file, spec.raw_size, rnd)
+        raw.append(file.relative_to(folder).as_posix())
+    for i in range(spec.private):
+        _write_data(folders.DATA_PRIVATE / f"private{i:04d}.csv", spec.private_size, rnd)
+    targets = [f"data/intermediate/g{i // SCRIPTS_PER_FOLDER:03d}/s{i:05d}.csv" for i in range(spec.scripts)]
+    dependencies = SHAPES[spec.shape]
+    for i in range(spec.scripts):
+        script = folders.SRC_PROCESSING / f"g{i // SCRIPTS_PER_FOLDER:03d}" / f"s{i:05d}.py"
+        script.parent.mkdir(parents=True, exist_ok=True)
+        inputs = dependencies(i, targets, raw, rnd)
+        script.write_text(_SCRIPT.format(i=i, shape=spec.shape, target=targets[i], inputs=", ".join(inputs)))
+    return folders
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", type=Path, help="Folder to create the compendium in")
+    parser.add_argument("--scripts", type=int, default=Spec.scripts, help="Number of scripts")
+    parser.add_argument("--shape", choices=list(SHAPES), default=Spec.shape, help="Shape of the dependency graph")
+    parser.add_argument("--raw", type=int, default=Spec.raw, help="Number of raw data files")
+    parser.add_argument("--raw-size", type=parse_size, default=Spec.raw_size, help="Size of each raw data file")
+    parser.add_argument("--private", type=int, default=Spec.private, help="Number of private files")
+    parser.add_argument("--private-size", type=parse_size, default=Spec.private_size,
+                        help="Size of each private file (e.g. 10M)")
+    parser.add_argument("--seed", type=int, default=Spec.seed, help="Random seed")
+    args = parser.parse_args()
+    spec = Spec(args.scripts, args.shape, args.raw, args.raw_size, args.private, args.private_size, args.seed)
+    os.makedirs(args.folder, exist_ok=True)
+    generate(args.folder, spec)
+    print(f"Created a {spec.shape} compendium with {spec.scripts} scripts in {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,20 +8,52 @@ import argparse
 import logging
 import sys
 
-from compendium.command import init, check, encrypt, COMMANDS, get_command
+from pathlib import Path
+from typing import Optional
+
+from compendium import instrument
+from compendium.command import COMMANDS, get_command
 from compendium.util import AbsolutePath
 
 
-def main():
-    parser = argparse.ArgumentParser(description=__doc__, prog='compendium')
+def add_global_arguments(parser: argparse.ArgumentParser):
     parser.add_argument("--verbose", "-v", help="Verbose output", action="store_true")
     parser.add_argument("--quiet", "-q", help="Quiet (minimal output)", action="store_true")
     parser.add_argument("--folder", "-f", help="Compendium root folder (default: current folder or parent)",
                         type=AbsolutePath)
+    parser.add_argument("--timings", action="store_true",
+                        help="Print how much time was spent in each phase (reading the configuration, finding files, "
+                             "parsing headers, key derivation and encryption, running scripts)")
+    parser.add_argument("--profile", metavar="FILE", type=Path,
+                        help="Profile the command and write the profile to FILE, in callgrind format if the name "
+                             "starts with callgrind or ends with .callgrind (e.g. callgrind.out), or as pstats "
+                             "otherwise (e.g. compendium.prof)")
+
+
+def get_used_command() -> Optional[str]:
+    """Find the command that is used, by parsing only the global options and the first positional argument"""
+    parser = argparse.ArgumentParser(add_help=False)
+    add_global_arguments(parser)
+    parser.add_argument("command", nargs="?")
+    try:
+        args, _rest = parser.parse_known_args()
+    except SystemExit:  # invalid global options, reported by the full parser
+        return None
+    return args.command
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, prog='compendium')
+    add_global_arguments(parser)
     subparsers = parser.add_subparsers(help='Sub commands', dest='command')
     subparsers.required = True
-    for command in COMMANDS:
-        command.add_subparser(subparsers)
+    # only import the command that is used, the other commands are listed with their help text
+    used = get_used_command()
+    for name, (_module, _cls, help) in COMMANDS.items():
+        if name == used:
+            get_command(name).add_subparser(subparsers)
+        else:
+            subparsers.add_parser(name, help=help)
 
     if len(sys.argv) == 1:
         print(__doc__, file=sys.stderr)
@@ -29,8 +61,24 @@ def main():
     level = (logging.DEBUG if args.verbose else (logging.WARN if args.quiet else logging.INFO))
     logging.basicConfig(level=level, format='[%(levelname)-5s] %(message)s')
 
-    cmd = get_command(args.command)
-    cmd.run(args)
+    if args.timings:
+        instrument.enable()
+    profile = None
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        cmd = get_command(args.command)
+        cmd.run(args)
+    finally:
+        # also report if the command failed or exited
+        if profile:
+            profile.disable()
+            instrument.write_profile(profile, args.profile)
+            logging.info(f"Profile written to {args.profile}")
+        if args.timings:
+            instrument.report()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import NamedTuple, List, Dict
+from typing import NamedTuple, List, Dict, Optional, Tuple
 
 
 class Action(NamedTuple):
@@ -8,3 +8,6 @@ class Action(NamedTuple):
     targets: List[Path]
     inputs: List[Path]
     headers: Dict[str, str]
+    name: str = None  # unique name, i.e. the path relative to the source folder
+    command: str = None  # for PIPE actions: the command without the redirection of stdin and stdout
+    codecs: Tuple[Optional[str], Optional[str]] = (None, None)  # for PIPE actions: compression of input and target
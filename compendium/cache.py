@@ -0,0 +1,215 @@
+"""
+Content-addressed cache of script outputs
+
+The outputs (CREATES) of an action are stored under a key computed from the contents of the script, its COMMAND,
+the contents of its inputs, and the environment lock files. As the key does not depend on the location of the
+compendium, the cache folder can be shared between clones (e.g. on a network drive), so an action that was already
+run anywhere can be restored rather than executed. The least recently used entries are evicted if the
+cache grows beyond its maximum size.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import List, Optional, NamedTuple, Dict
+
+from compendium.action import Action
+from compendium.util import format_size, write_json
+
+# Files that define the software environment, changing these invalidates all cache entries
+LOCKFILES = ["requirements.txt", "requirements.lock", "setup.py", "Pipfile.lock", "poetry.lock", "renv.lock"]
+
+META = "meta.json"
+STATS = "stats.jsonl"
+
+
+class CacheEntry(NamedTuple):
+    key: str
+    folder: Path
+    size: int
+    last_used: float
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    entries: int
+    size: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ArtifactCache:
+    def __init__(self, folder: Path, max_size: Optional[int] = None):
+        self.folder = folder
+        self.max_size = max_size
+        self.objects = folder / "objects"
+
+    # **** Cache keys ****
+
+    def get_key(self, root: Path, action: Action, digests: "DigestIndex") -> str:
+        """Compute the cache key for this action, using paths relative to root so the key is the same in any clone"""
+        def _rel(f: Path) -> str:
+            f = f if f.is_absolute() else root / f
+            return f.relative_to(root).as_posix()
+        parts = {
+            "script": [_rel(action.file), digests.get(action.file)],
+            "command": action.headers.get("COMMAND"),
+            "pipe": action.headers.get("PIPE"),
+            "inputs": [[_rel(f), digests.get(root / f)] for f in action.inputs],
+            "targets": [_rel(f) for f in action.targets],
+            "env": [[name, digests.get(root / name)] for name in LOCKFILES if (root / name).exists()],
+        }
+        return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode("utf-8"), digest_size=20).hexdigest()
+
+    # **** Storing and restoring ****
+
+    def _entry_folder(self, key: str) -> Path:
+        return self.objects / key[:2] / key
+
+    def restore(self, key: str, targets: List[Path]) -> bool:
+        """Copy the cached outputs to targets if this key is in the cache, returning whether it was a hit"""
+        folder = self._entry_folder(key)
+        try:
+            with (folder / META).open() as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._log("miss", key)
+            return False
+        if len(meta["files"]) != len(targets):
+            self._log("miss", key)
+            return False
+        for i, target in enumerate(targets):
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # copy rather than link, as scripts may overwrite their outputs in place
+            shutil.copyfile(folder / str(i), target)
+        os.utime(folder / META)  # mark as recently used
+        self._log("hit", key, meta["size"])
+        return True
+
+    def store(self, key: str, targets: List[Path]):
+        """Store the targets in the cache"""
+        folder = self._entry_folder(key)
+        if (folder / META).exists():
+            return
+        missing = [t for t in targets if not t.is_file()]
+        if missing:
+            logging.warning(f"Not caching outputs, targets do not exist: {missing}")
+            return
+        tmp = folder.with_name(f".{key}.{os.getpid()}.tmp")
+        tmp.mkdir(parents=True)
+        try:
+            for i, target in enumerate(targets):
+                shutil.copyfile(target, tmp / str(i))
+            meta = dict(files=[t.name for t in targets], size=sum(t.stat().st_size for t in targets),
+                        created=time.time())
+            with (tmp / META).open("w") as f:
+                json.dump(meta, f)
+            try:
+                os.rename(tmp, folder)
+            except OSError:  # stored concurrently by someone else
+                pass
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp)
+        logging.debug(f"Stored {len(targets)} file(s) ({format_size(meta['size'])}) in cache as {key}")
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    # **** Maintenance ****
+
+    def entries(self) -> List[CacheEntry]:
+        result = []
+        if not self.objects.is_dir():
+            return result
+        for prefix in os.scandir(self.objects):
+            for entry in os.scandir(prefix.path):
+                if entry.name.startswith("."):
+                    continue
+                meta = Path(entry.path) / META
+                try:
+                    with meta.open() as f:
+                        size = json.load(f)["size"]
+                    result.append(CacheEntry(entry.name, Path(entry.path), size, meta.stat().st_mtime))
+                except (FileNotFoundError, ValueError, KeyError):
+                    continue
+        return result
+
+    def evict(self, max_size: int) -> int:
+        """Remove the least recently used entries until the cache is at most max_size bytes, return #removed"""
+        entries = sorted(self.entries(), key=lambda e: e.last_used)
+        total, removed = sum(e.size for e in entries), 0
+        for entry in entries:
+            if total <= max_size:
+                break
+            logging.debug(f"Evicting {entry.key} ({format_size(entry.size)}) from cache")
+            shutil.rmtree(entry.folder, ignore_errors=True)
+            total -= entry.size
+            removed += 1
+        return removed
+
+    def _log(self, event: str, key: str, size: int = None):
+        """Append a hit/miss event to the statistics log (single appends are atomic, even if shared)"""
+        record = json.dumps(dict(time=time.time(), event=event, key=key, size=size))
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            with (self.folder / STATS).open("a") as f:
+                f.write(record + "\n")
+        except OSError as e:
+            logging.debug(f"Could not write cache statistics: {e}")
+
+    def stats(self) -> CacheStats:
+        counts: Dict[str, int] = {"hit": 0, "miss": 0}
+        if (self.folder / STATS).exists():
+            with (self.folder / STATS).open() as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)["event"]
+                    except (ValueError, KeyError):
+                        continue
+                    counts[event] = counts.get(event, 0) + 1
+        entries = self.entries()
+        return CacheStats(counts["hit"], counts["miss"], len(entries), sum(e.size for e in entries))
+
+
+class DigestIndex:
+    """Digests of file contents, stored on disk and only recomputed if the modification time or size changed"""
+
+    def __init__(self, file: Path):
+        self.file = file
+        self.entries: Dict[str, list] = {}
+        self.changed = False
+        try:
+            with file.open() as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.debug(f"Ignoring unreadable digest index {file}: {e}")
+
+    def get(self, file: Path) -> str:
+        stat = file.stat()
+        entry = self.entries.get(str(file))
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return entry[2]
+        from compendium.encryption import file_digest  # imports cryptography, which is not needed otherwise
+        digest = file_digest(file)
+        self.entries[str(file)] = [stat.st_mtime_ns, stat.st_size, digest]
+        self.changed = True
+        return digest
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            # the runner can save the index from several threads at the same time
+            write_json(self.file, self.entries)
+        except OSError as e:
+            logging.debug(f"Could not write digest index {self.file}: {e}")
+        self.changed = False
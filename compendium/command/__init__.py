@@ -1,16 +1,24 @@
-from compendium.command.check import Check
-from compendium.command.encrypt import Encrypt
-from compendium.command.init import Init
+"""
+The compendium commands. The command modules are only imported when the command is used, so the command line
+starts quickly (e.g. `compendium check` does not need to load cryptography or doit)
+"""
+import importlib
 
-COMMANDS = [
-    Init,
-    Check,
-    Encrypt,
-]
+# name: (module, class, help text)
+COMMANDS = {
+    "init": ("compendium.command.init", "Init", "Setup a new compendium folder"),
+    "check": ("compendium.command.check", "Check", "Generic checks for compendium completeness and consistence"),
+    "encrypt": ("compendium.command.encrypt", "Encrypt", "Encrypt files from private-raw to private-raw-encrypted"),
+    "decrypt": ("compendium.command.decrypt", "Decrypt", "Decrypt files from private-raw-encrypted to private-raw"),
+    "run": ("compendium.command.run", "Run",
+            "Run all scripts that are not up to date, in parallel where the dependencies allow"),
+    "stats": ("compendium.command.stats", "Stats", "Show the slowest, most memory-hungry, and most regressed scripts"),
+    "cache": ("compendium.command.cache", "Cache", "Show statistics of the artifact cache and evict old entries"),
+}
 
 
 def get_command(name: str):
-    for cmd in COMMANDS:
-        if cmd.get_name() == name:
-            return cmd
-    raise ValueError(f"Unknown command: {name}")
+    if name not in COMMANDS:
+        raise ValueError(f"Unknown command: {name}")
+    module, cls, _help = COMMANDS[name]
+    return getattr(importlib.import_module(module), cls)
@@ -0,0 +1,34 @@
+"""
+Inspect and maintain the artifact cache
+"""
+import sys
+from argparse import Namespace
+
+from compendium.command.command import CompendiumCommand
+from compendium.compendium import Compendium
+from compendium.util import format_size, parse_size
+
+
+class Cache(CompendiumCommand):
+    """Show statistics of the artifact cache and evict old entries"""
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument("--evict", metavar="SIZE", type=parse_size,
+                            help="Remove least recently used entries until the cache is at most SIZE (e.g. 10G)")
+
+    @classmethod
+    def do_run(cls, compendium: Compendium, args: Namespace):
+        cache = compendium.cache
+        if cache is None:
+            print("No artifact cache configured, add a [cache] section with 'folder' (and optionally 'max_size') "
+                  "to .compendium.cfg", file=sys.stderr)
+            sys.exit(1)
+        if args.evict is not None:
+            removed = cache.evict(args.evict)
+            print(f"Removed {removed} entries from {cache.folder}")
+        stats = cache.stats()
+        print(f"Artifact cache at {cache.folder}")
+        print(f"- {stats.entries} entries, {format_size(stats.size)}"
+              + (f" (maximum {format_size(cache.max_size)})" if cache.max_size is not None else ""))
+        print(f"- {stats.hits} hits, {stats.misses} misses (hit rate {stats.hit_rate:.0%})")
@@ -1,11 +1,12 @@
-
-
 import logging
 import sys
 
 from argparse import Namespace
-from collections import defaultdict
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Mapping, Iterable, List, TypeVar
 
+from compendium import instrument
 from compendium.command.command import CompendiumCommand
 from compendium.compendium import Compendium
 from compendium.initsegment import SEGMENTS
@@ -14,6 +15,8 @@ from compendium.util import contained_in
 _CHECK_OK = '\u2714\u2009'
 _CHECK_FAIL = '\u2718\u2009'
 
+T = TypeVar("T")
+
 
 class Check(CompendiumCommand):
     """
@@ -23,58 +26,140 @@ class Check(CompendiumCommand):
     @classmethod
     def run(self, args: Namespace):
         compendium = Compendium(args.folder)
-        run_checks(compendium)
+        if not run_checks(compendium):
+            sys.exit(1)
 
 
-def run_checks(compendium: Compendium):
+def run_checks(compendium: Compendium) -> bool:
+    """Run all checks, printing the outcomes. Returns True if there were no errors"""
     for segment in SEGMENTS:
-        for check, outcome in segment(compendium).check():
+        with instrument.span(f"check {segment.__name__}"):
+            outcomes = list(segment(compendium).check())
+        for check, outcome in outcomes:
             print(f"[{_CHECK_OK if outcome else _CHECK_FAIL}] {check}")
+    errors = do_check(compendium)
+    print(f"[{_CHECK_FAIL if errors else _CHECK_OK}] Dependency graph")
+    for error in errors:
+        print(f"  - {error}", file=sys.stderr)
+    return not errors
 
 
-def get_cycles(graph):
-    def cycles_node(graph, node, visited=None):
-        # Can I find a cycle in the depth-first graph starting from this node?
-        if visited is None:
-            visited = set()
-        for neighbour in graph.get(node, []):
-            #print(f"{node} -> {neighbour} (visited: {visited})")
-            if neighbour in visited:
-                yield neighbour
+def strongly_connected_components(graph: Mapping[T, Iterable[T]]) -> List[List[T]]:
+    """
+    Find the strongly connected components of a directed graph (as a node -> successors mapping).
+    Uses Tarjan's algorithm (without recursion), which runs in linear time.
+    """
+    index, lowlink = {}, {}
+    stack, on_stack = [], set()
+    components = []
+    for root in list(graph):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph.get(successor, ()))))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
             else:
-                visited.add(neighbour)
-                yield from cycles_node(graph, neighbour, visited)
+                # all successors of node are done
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def get_cycles(graph: Mapping[T, Iterable[T]]) -> Iterable[List[T]]:
+    """
+    Yield a cycle for every strongly connected component that contains one,
+    as an ordered path of nodes that starts and ends with the same node
+    """
+    for component in strongly_connected_components(graph):
+        if len(component) > 1 or component[0] in graph.get(component[0], ()):
+            yield _find_cycle(graph, component)
 
-    # for any node, can you find a cycle?
-    for n in graph:
-        yield from cycles_node(graph, n)
 
+def _find_cycle(graph: Mapping[T, Iterable[T]], component: List[T]) -> List[T]:
+    """Find the shortest path from the first node in the strongly connected component back to itself"""
+    members, start = set(component), component[0]
+    parents, queue = {start: None}, deque([start])
+    while queue:
+        node = queue.popleft()
+        for successor in graph.get(node, ()):
+            if successor == start:
+                path = [node]
+                while parents[path[-1]] is not None:
+                    path.append(parents[path[-1]])
+                return path[::-1] + [start]
+            if successor in members and successor not in parents:
+                parents[successor] = node
+                queue.append(successor)
+    raise ValueError("Component does not contain a cycle")
 
-def do_check(args):
+
+def do_check(compendium: Compendium) -> List[str]:
     """
-    Run sanity checks on the package
+    Check the consistency of the dependency graph, returning a list of errors
     """
     logging.info("Checking consistency of dependency graph")
-    inputs, outputs, graph = set(), set(), defaultdict(set)
-    for action in get_actions():
-        inputs |= set(action.inputs)
-        outputs |= set(action.targets)
-        for output in action.targets:
-            for input in action.inputs:
+    folders = compendium.folders
+
+    def _abs(f: Path) -> Path:
+        return f if f.is_absolute() else compendium.root / f
+
+    inputs, graph, producers = set(), defaultdict(set), defaultdict(list)
+    for action in compendium.get_actions():
+        action_inputs = [_abs(f) for f in action.inputs]
+        action_targets = [_abs(f) for f in action.targets]
+        inputs |= set(action_inputs)
+        for output in action_targets:
+            producers[output].append(action.file)
+            for input in action_inputs:
                 graph[input].add(output)
     errors = []
+    for output, files in producers.items():
+        if len(files) > 1:
+            errors.append(f"File {_l(compendium, output)} is produced by multiple scripts: "
+                          f"{', '.join(f.name for f in files)}")
     # check: all inputs need to be either in raw and exist, in private_raw, or in outputs
-    for input in inputs - outputs:
-        if contained_in(DATA_RAW, input):
-            errors.append(f"Input file {input} does not exist")
-        elif not contained_in(DATA_PRIVATE, input):
-            errors.append(f"Intermediate file {input} is not produced by any script")
+    for input in sorted(inputs - producers.keys()):
+        if contained_in(folders.DATA_PRIVATE, input):
+            continue
+        if contained_in(folders.DATA_RAW, input):
+            if not input.exists():
+                errors.append(f"Input file {_l(compendium, input)} does not exist")
+        else:
+            errors.append(f"Intermediate file {_l(compendium, input)} is not produced by any script")
     # check that graph does not contain any cycles
-    cycles = set(get_cycles(graph))
+    with instrument.span("check cycles"):
+        cycles = list(get_cycles(graph))
     for cycle in cycles:
-        errors.append(f"Cyclical dependency for file {cycle}")
-    if errors:
-        print("Package checking resulted in one or more errors:", file=sys.stderr)
-        for error in errors:
-            print(f"- {error}", file=sys.stderr)
-        sys.exit(1)
\ No newline at end of file
+        errors.append(f"Cyclical dependency: {' -> '.join(str(_l(compendium, f)) for f in cycle)}")
+    return errors
+
+
+def _l(compendium: Compendium, f: Path) -> Path:
+    """Shorten file name for display"""
+    try:
+        return f.relative_to(compendium.root)
+    except ValueError:
+        return f
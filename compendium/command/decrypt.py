@@ -0,0 +1,32 @@
+"""
+Decrypt files in the raw-private-encrypted folder to raw-private
+"""
+import sys
+from argparse import Namespace
+
+from compendium.command.command import CompendiumCommand
+from compendium.command.encrypt import Encrypt
+from compendium.compendium import Compendium
+
+
+class Decrypt(CompendiumCommand):
+    """Decrypt files from private-raw-encrypted to private-raw"""
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument("--password",
+                            help="Specify the password")
+        parser.add_argument("--jobs", "-j", type=int, default=0,
+                            help="Number of files to decrypt in parallel (default: number of CPUs)")
+        parser.add_argument("--force", action="store_true",
+                            help="Decrypt all files, also the files that were already decrypted")
+
+    @classmethod
+    def do_run(cls, compendium: Compendium, args: Namespace):
+        from cryptography.fernet import InvalidToken
+        password = Encrypt.get_password(args)
+        try:
+            compendium.decrypt_all(password, jobs=args.jobs or None, overwrite=args.force)
+        except InvalidToken:
+            print("Incorrect password, could not decrypt files", file=sys.stderr)
+            sys.exit(1)
@@ -3,16 +3,24 @@ Encrypt files in the raw-private folder to raw-private-encrypted
 """
 
 import logging
+import os
 import sys
+import time
 from argparse import Namespace
+from functools import partial
 from getpass import getpass
+from itertools import chain
 from pathlib import Path
-from typing import Optional, Iterable
+from typing import Optional, Iterable, List, Tuple
 
+from cryptography.fernet import InvalidToken
 
 from compendium.command.command import CompendiumCommand
-from compendium.compendium import Compendium
-from compendium.encryption import encrypt_file, verify_file, get_key
+from compendium.compendium import Compendium, CONFIGFILE
+from compendium.encryption import (encrypt_file, verify_file, map_files, file_digests, file_version, upgrade_file,
+                                   get_key, calibrate, KDF, VERSION_AEAD)
+from compendium.manifest import Manifest
+from compendium.util import format_throughput, format_size, contained_in
 
 
 class Encrypt(CompendiumCommand):
@@ -26,49 +34,220 @@ class Encrypt(CompendiumCommand):
                             help="Specify the password")
         parser.add_argument("--verify", action="store_true",
                             help="Test whether all files are correctly encrypted with this password")
+        parser.add_argument("--jobs", "-j", type=int, default=1,
+                            help="Number of files to encrypt or verify in parallel (0 = number of CPUs)")
+        parser.add_argument("--force", action="store_true",
+                            help="Encrypt all files, even if they did not change since the last encryption")
+        parser.add_argument("--full", action="store_true",
+                            help="With --verify, decrypt all files rather than comparing them with the manifest")
+        parser.add_argument("--kdf", metavar="KDF",
+                            help="Change the key derivation function (e.g. 'scrypt n=65536 r=8 p=1', or only the "
+                                 "algorithm pbkdf2, scrypt or argon2id with --calibrate) and re-encrypt all files")
+        parser.add_argument("--calibrate", metavar="SECONDS", type=float,
+                            help="Choose the key derivation parameters so deriving the key takes SECONDS on this "
+                                 "machine, and re-encrypt all files")
+        parser.add_argument("--upgrade", action="store_true",
+                            help="Convert encrypted files in an older format to the current format "
+                                 "(does not need the private files)")
 
     @classmethod
     def do_run(cls, compendium: Compendium, args: Namespace):
-        def _l(f: Path) -> Path:
-            return f.relative_to(compendium.root)
+        if args.kdf or args.calibrate:
+            try:
+                kdf = KDF.parse(args.kdf or compendium.kdf.algorithm)
+                if args.calibrate:
+                    logging.info(f"Calibrating {kdf.algorithm} to take {args.calibrate}s")
+                    kdf = calibrate(kdf.algorithm, args.calibrate)
+            except ValueError as e:
+                print(str(e), file=sys.stderr)
+                sys.exit(1)
+            manifest = Manifest(compendium.folders.DATA_ENCRYPTED)
+            try:
+                cls.rekey(compendium, cls.get_password(args), kdf, manifest, args.jobs or os.cpu_count())
+            except ValueError as e:  # e.g. parameters that the key derivation function does not accept
+                print(str(e), file=sys.stderr)
+                sys.exit(1)
+            manifest.save()
+            return
+        if args.upgrade:
+            key = compendium.get_key(cls.get_password(args))
+            manifest = Manifest(compendium.folders.DATA_ENCRYPTED)
+            cls.upgrade(compendium, key, manifest, args.jobs or os.cpu_count())
+            manifest.save()
+            return
         if args.verify:
-            for file in compendium.folders.DATA_ENCRYPTED.glob("*"):
-                infile = compendium.folders.DATA_PRIVATE/file.name
+            for file in compendium.encrypted_files():
+                infile = compendium.decrypted_path(file)
                 if not infile.exists():
-                    logging.warning(f"WARNING: Encrypted file {_l(file)} "
-                                    f"has no corresponding file in {_l(compendium.PRIVATE)}")
+                    logging.warning(f"WARNING: Encrypted file {_l(compendium, file)} "
+                                    f"has no corresponding file in {_l(compendium, compendium.folders.DATA_PRIVATE)}")
 
-        files = list(get_files(compendium.folders.DATA_PRIVATE, args.files))
+        files = list(get_files(compendium, args.files))
         if not files:
             print("No files to encrypt, exiting", file=sys.stderr)
             sys.exit(1)
-        if not args.password:
-            args.password = getpass("Please specify the password to use: ").strip()
-        if not args.password:
-            print("No password given, aborting", file=sys.stderr)
-            sys.exit(1)
+        password = cls.get_password(args)
         if not compendium.folders.DATA_ENCRYPTED.exists():
             logging.debug(f"Creating {compendium.folders.DATA_ENCRYPTED}")
             compendium.folders.DATA_ENCRYPTED.mkdir()
-        key = get_key(compendium.salt, args.password)
-        action = 'Encrypting' if not args.verify else 'Verifying'
-        logging.info(f"{action} {len(files)} file(s) from {_l(compendium.folders.DATA_PRIVATE)}")
-        for file in files:
-            outfile = compendium.folders.DATA_ENCRYPTED/file.name
-            if args.verify:
-                logging.debug(f".. {_l(outfile)} -> {_l(file)}?")
-                if not outfile.exists():
-                    print(f"WARNING: File {_l(outfile)} does not exist")
-                elif not verify_file(key, file, outfile):
-                    print(f"WARNING: File {_l(file)} could not be decrypted from {_l(outfile)}", file=sys.stderr)
+        key = compendium.get_key(password)
+        jobs = args.jobs or os.cpu_count()
+        manifest = Manifest(compendium.folders.DATA_ENCRYPTED)
+        pairs = [(file, compendium.encrypted_path(file)) for file in files]
+        if args.verify:
+            cls.verify(compendium, key, manifest, pairs, jobs, full=args.full)
+        else:
+            cls.encrypt(compendium, key, manifest, pairs, jobs, force=args.force)
+            if not args.files:
+                manifest.keep_only(_name(compendium, file) for file in files)
+            manifest.save()
+
+    @staticmethod
+    def get_password(args: Namespace) -> str:
+        password = args.password or getpass("Please specify the password to use: ").strip()
+        if not password:
+            print("No password given, aborting", file=sys.stderr)
+            sys.exit(1)
+        return password
+
+    @classmethod
+    def encrypt(cls, compendium: Compendium, key: bytes, manifest: Manifest, pairs: List[Tuple[Path, Path]],
+                jobs: int, force=False):
+        """Encrypt all new or changed files, recording their digests in the manifest"""
+        logging.info(f"Checking {len(pairs)} file(s) from {_l(compendium, compendium.folders.DATA_PRIVATE)}")
+        digests = {file: digest for (file, _outfile, digest, _seconds) in map_files(file_digests, key, pairs, jobs)}
+        if not force:
+            pairs = [(file, outfile) for (file, outfile) in pairs
+                     if not manifest.is_current(_name(compendium, file), *digests[file])]
+        if not pairs:
+            logging.info("All encrypted files are up to date")
+            return
+        logging.info(f"Encrypting {len(pairs)} new or changed file(s)")
+        nbytes = sum(file.stat().st_size for (file, _outfile) in pairs)
+        for folder in {outfile.parent for (_file, outfile) in pairs}:
+            folder.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        for file, outfile, encrypted_digest, _seconds in map_files(encrypt_file, key, pairs, jobs):
+            logging.debug(f".. {file} -> {outfile}")
+            manifest.set(_name(compendium, file), digests[file][0], encrypted_digest)
+        logging.info(f"Encrypting done: {format_throughput(nbytes, time.perf_counter() - start)}")
+
+    @classmethod
+    def verify(cls, compendium: Compendium, key: bytes, manifest: Manifest, pairs: List[Tuple[Path, Path]],
+               jobs: int, full=False):
+        """Verify files against the manifest if possible, otherwise (or if full is True) by decrypting them"""
+        logging.info(f"Verifying {len(pairs)} file(s) from {_l(compendium, compendium.folders.DATA_PRIVATE)}")
+        existing = []
+        for file, outfile in pairs:
+            if not outfile.exists():
+                print(f"WARNING: File {_l(compendium, outfile)} does not exist")
+            else:
+                existing.append((file, outfile))
+        in_manifest = [] if full else [(file, outfile) for (file, outfile) in existing
+                                       if manifest.get(_name(compendium, file))]
+        skip = set(in_manifest)
+        to_decrypt = [pair for pair in existing if pair not in skip]
+        nbytes = sum(file.stat().st_size for (file, _outfile) in existing)
+        start = time.perf_counter()
+        checked = ((file, outfile, manifest.is_current(_name(compendium, file), *digests), seconds)
+                   for (file, outfile, digests, seconds) in map_files(file_digests, key, in_manifest, jobs))
+        for file, outfile, ok, seconds in chain(checked, map_files(verify_file, key, to_decrypt, jobs)):
+            logging.info(f".. {_l(compendium, file)}: {'OK' if ok else 'FAILED'}, "
+                         f"{format_throughput(file.stat().st_size, seconds)}")
+            if not ok:
+                print(f"WARNING: File {_l(compendium, file)} could not be decrypted "
+                      f"from {_l(compendium, outfile)}", file=sys.stderr)
+        logging.info(f"Verified {len(in_manifest)} file(s) using the manifest and {len(to_decrypt)} by decrypting: "
+                     f"{format_throughput(nbytes, time.perf_counter() - start)}")
+
+
+    @classmethod
+    def upgrade(cls, compendium: Compendium, key: bytes, manifest: Manifest, jobs: int):
+        """Re-encrypt all encrypted files that are not in the current format, in place"""
+        files = [file for file in compendium.encrypted_files() if file_version(file) != VERSION_AEAD]
+        if not files:
+            logging.info("All encrypted files are in the current format")
+            return
+        logging.info(f"Upgrading {len(files)} encrypted file(s) to the current format")
+        before = sum(file.stat().st_size for file in files)
+        start = time.perf_counter()
+        failed = 0
+        for file, _outfile, result, _seconds in map_files(_upgrade_file, key, [(f, f) for f in files], jobs):
+            if result is None:
+                print(f"WARNING: File {_l(compendium, file)} could not be decrypted, not upgraded", file=sys.stderr)
+                failed += 1
             else:
-                logging.debug(f".. {file} -> {outfile}")
-                encrypt_file(key, file, outfile)
+                manifest.set(_name(compendium, compendium.decrypted_path(file)), *result)
+        after = sum(file.stat().st_size for file in files)
+        logging.info(f"Upgrading done: {format_size(before)} -> {format_size(after)}, "
+                     f"{format_throughput(before, time.perf_counter() - start)}")
+        if failed:
+            sys.exit(1)
+
+
+    @classmethod
+    def rekey(cls, compendium: Compendium, password: str, kdf: KDF, manifest: Manifest, jobs: int):
+        """
+        Change the key derivation function, re-encrypting all encrypted files with the new key. The files are only
+        replaced once all files are re-encrypted, so a wrong password leaves them unchanged. The new key derivation
+        function is logged before the files are replaced and saved right after, so if replacing them is
+        interrupted, the replaced files can be decrypted by setting the logged kdf in the configuration file
+        """
+        files = compendium.encrypted_files()
+        if files:
+            key = compendium.get_key(password)
+            start = time.perf_counter()
+            new_key = get_key(compendium.salt, password, kdf)
+            logging.info(f"Deriving the key with {kdf} took {time.perf_counter() - start:.2f}s")
+            logging.info(f"Re-encrypting {len(files)} file(s) with the new key")
+            pairs = [(file, file.with_name(f".{file.name}.rekey")) for file in files]
+            results = {}
+            try:
+                for file, _tmp, result, _seconds in map_files(partial(_upgrade_file, new_key=new_key), key, pairs,
+                                                              jobs):
+                    if result is None:
+                        print(f"ERROR: File {_l(compendium, file)} could not be decrypted, nothing was changed",
+                              file=sys.stderr)
+                        sys.exit(1)
+                    results[file] = result
+                logging.info(f"Replacing the encrypted files, if this is interrupted set kdf = {kdf} in the "
+                             f"[encryption] section of {CONFIGFILE} to decrypt the replaced files")
+                for file, tmp in pairs:
+                    os.replace(tmp, file)
+                    manifest.set(_name(compendium, compendium.decrypted_path(file)), *results[file])
+            finally:
+                for _file, tmp in pairs:
+                    try:
+                        tmp.unlink()
+                    except FileNotFoundError:
+                        pass
+        compendium.kdf = kdf
+        logging.info(f"Key derivation function set to {kdf}")
+        compendium.save()
+
+
+def _upgrade_file(key: bytes, infile: Path, outfile: Path, new_key: bytes = None) -> Optional[Tuple[str, str]]:
+    """Upgrade a file (see upgrade_file), returning None if it cannot be decrypted"""
+    try:
+        return upgrade_file(key, infile, outfile, new_key=new_key)
+    except InvalidToken:
+        return None
+
+
+def _l(compendium: Compendium, f: Path) -> Path:
+    """Shorten file name for logging"""
+    return f.relative_to(compendium.root)
+
+
+def _name(compendium: Compendium, file: Path) -> str:
+    """Name of a private file in the manifest"""
+    return file.relative_to(compendium.folders.DATA_PRIVATE).as_posix()
 
 
-def get_files(folder: Path, files: Optional[Iterable[str]]):
+def get_files(compendium: Compendium, files: Optional[Iterable[str]]):
+    folder = compendium.folders.DATA_PRIVATE
     if not files:
-        yield from folder.glob("*")
+        yield from compendium.private_files()
     else:
         for file in files:
             if file.startswith("/"):  # absolute path
@@ -77,6 +256,6 @@ def get_files(folder: Path, files: Optional[Iterable[str]]):
                 file = Path.cwd()/file
             else:  # relative wrt private data folder
                 file = folder/file
-            if file.parent != folder:
+            if not contained_in(folder, file):
                 raise Exception(f"Cannot encrypt {file}, not in {folder}")
-            yield file
\ No newline at end of file
+            yield file
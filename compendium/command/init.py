@@ -3,6 +3,7 @@ import sys
 
 from argparse import Namespace
 
+from compendium import instrument
 from compendium.command.command import CompendiumCommand
 from compendium.initsegment import SEGMENTS
 
@@ -27,11 +28,13 @@ class Init(CompendiumCommand):
                 return
         initial_segment = SEGMENTS[0]()  # initial initsegment is responsible for creating compendium
         initial_segment.interactive_arguments(args)
-        compendium = initial_segment.run(args)
+        with instrument.span(f"init {SEGMENTS[0].__name__}"):
+            compendium = initial_segment.run(args)
         for segment_class in SEGMENTS[1:]:
             segment = segment_class(compendium)
             segment.interactive_arguments(args)
-            segment.run(args)
+            with instrument.span(f"init {segment_class.__name__}"):
+                segment.run(args)
         compendium.save()
 
 
@@ -0,0 +1,60 @@
+"""
+Run the processing and analysis scripts in parallel
+"""
+import os
+import sys
+from argparse import Namespace
+from pathlib import Path
+
+from compendium.command.command import CompendiumCommand
+from compendium.compendium import Compendium
+from compendium.util import parse_size
+
+
+class Run(CompendiumCommand):
+    """Run all scripts that are not up to date, in parallel where the dependencies allow"""
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument("targets", nargs="*",
+                            help="Only run the scripts needed for these scripts or target files (default: all)")
+        parser.add_argument("--jobs", "-j", type=int, default=0,
+                            help="Number of scripts to run in parallel (default: number of CPUs)")
+        parser.add_argument("--force", action="store_true",
+                            help="Run scripts even if their targets are up to date (private files that are already decrypted "
+                                 "and the python environment are kept)")
+        parser.add_argument("--cpus", type=int,
+                            help="Number of CPUs available to the scripts, see the #THREADS header "
+                                 "(default: [run] cpus in .compendium.cfg or number of CPUs)")
+        parser.add_argument("--memory", type=parse_size,
+                            help="Memory available to the scripts (e.g. 32G), see the #MEMORY header "
+                                 "(default: [run] memory in .compendium.cfg or total memory)")
+        parser.add_argument("--fuse", action="store_true",
+                            help="Stream chains of PIPE scripts through memory instead of writing the intermediate "
+                                 "files, unless a script has #KEEP: TRUE (default: [run] fuse in .compendium.cfg)")
+        parser.add_argument("--passphrase",
+                            help="Passphrase to decrypt the private files that are not decrypted yet")
+        parser.add_argument("--tmp-private", action="store_true",
+                            help="Decrypt the private files to a temporary folder (in memory if possible) that is "
+                                 "removed after the run (default: [run] tmp_private in .compendium.cfg)")
+        parser.add_argument("--trace", metavar="FILE", type=Path,
+                            help="Write a timeline of the run to FILE (e.g. trace.json), "
+                                 "which can be opened in https://ui.perfetto.dev or chrome://tracing")
+
+    @classmethod
+    def do_run(cls, compendium: Compendium, args: Namespace):
+        from compendium.runner import Runner
+        cpus = args.cpus or int(compendium.get("run", "cpus", 0))
+        memory = args.memory or parse_size(compendium.get("run", "memory", "0"))
+        fuse = args.fuse or compendium.cf.getboolean("run", "fuse", fallback=False)
+        tmp_private = args.tmp_private or compendium.cf.getboolean("run", "tmp_private", fallback=False)
+        try:
+            runner = Runner(compendium, jobs=args.jobs or cpus or os.cpu_count(), force=args.force,
+                            cpus=cpus, memory=memory, passphrase=args.passphrase, trace=args.trace,
+                            fuse=fuse, tmp_private=tmp_private)
+            ok = runner.run(runner.select(args.targets) if args.targets else None)
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            sys.exit(1)
+        if not ok:
+            sys.exit(1)
@@ -0,0 +1,47 @@
+"""
+Report on the recorded durations and resource usage of the scripts
+"""
+import sys
+from argparse import Namespace
+from typing import Callable
+
+from compendium.command.command import CompendiumCommand
+from compendium.compendium import Compendium
+from compendium.telemetry import RunLog, RUNLOG, regression
+from compendium.util import format_size
+
+
+class Stats(CompendiumCommand):
+    """Show the slowest, most memory-hungry, and most regressed scripts"""
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument("--top", "-n", type=int, default=10,
+                            help="Number of scripts to list in each category (default: 10)")
+
+    @classmethod
+    def do_run(cls, compendium: Compendium, args: Namespace):
+        history = RunLog(compendium.folders.STATE / RUNLOG).history()
+        if not history:
+            print("No runs recorded yet, use doit or compendium run to run the scripts", file=sys.stderr)
+            return
+        latest = {name: runs[-1] for (name, runs) in history.items()}
+        print(f"Recorded runs of {len(history)} script(s), based on the latest successful run of each script")
+
+        def table(title: str, key: Callable[[dict], float], columns: Callable[[dict], str]):
+            print(f"\n{title}")
+            names = sorted(latest, key=lambda name: key(latest[name]), reverse=True)[:args.top]
+            width = max((len(name) for name in names), default=0)
+            for name in names:
+                print(f"  {name:<{width}}  {columns(latest[name])}")
+
+        table("Slowest scripts (wall time, CPU time):", key=lambda r: r["wall"],
+              columns=lambda r: f"{r['wall']:>8.1f}s {r.get('cpu', 0):>8.1f}s CPU")
+        def _size(r: dict, field: str) -> str:
+            return f"{format_size(r.get(field, 0)):>8}"
+        table("Most memory-hungry scripts (peak memory, data read and written):", key=lambda r: r.get("max_rss", 0),
+              columns=lambda r: f"{_size(r, 'max_rss')} {_size(r, 'read_bytes')} read {_size(r, 'write_bytes')} written")
+        for name, runs in history.items():
+            latest[name]["regression"] = regression(runs)
+        table("Most regressed scripts (latest wall time compared to the median of the previous runs):",
+              key=lambda r: r["regression"], columns=lambda r: f"{r['regression']:>6.2f}x {r['wall']:>8.1f}s")
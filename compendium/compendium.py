@@ -1,21 +1,46 @@
 import logging
+import os
+import re
+import subprocess
+import sys
+import secrets
+import time
 from argparse import Namespace
+from functools import lru_cache
 from configparser import ConfigParser, NoSectionError, NoOptionError
-import crypt
 from pathlib import Path
-from typing import Optional, Iterable
-
-from cryptography.fernet import InvalidToken
-from doit.exceptions import TaskFailed
+from typing import Optional, Iterable, List, Dict, Tuple, TYPE_CHECKING
 
+from compendium import instrument
 from compendium.action import Action
-from compendium.encryption import get_key, decrypt_file
-from compendium.util import get_files, get_headers, parse_files, call
+from compendium.cache import ArtifactCache, DigestIndex
+from compendium.headerindex import HeaderIndex
+from compendium.taskindex import TaskIndex
+from compendium.telemetry import RunLog, RUNLOG, Usage, run_measured, run_pipeline
+from compendium.util import walk_files, parse_files, parse_foreach, glob_base, contained_in, call, format_throughput, parse_size
+
+if TYPE_CHECKING:
+    from compendium.encryption import KDF
+
+# cryptography and doit are imported in the methods that need them, so loading the compendium (e.g. for
+# `compendium check` or `doit list`) stays fast
 
 CONFIGFILE = ".compendium.cfg"
 
 EXT_SCRIPT = {".py", ".R", ".Rmd", ".sh"}
 
+# Compression of intermediate files: the suffix, and the commands to compress and decompress stdin to stdout
+CODECS = {
+    "gzip": (".gz", "gzip -c", "gzip -dc"),
+    "zstd": (".zst", "zstd -q -c", "zstd -q -dc"),
+}
+
+# The input, target and key of one shard of a FOREACH script
+Shard = Tuple[Path, Path, str]
+# A script with its folder, headers, and (for FOREACH scripts) shard
+Script = Tuple[Path, Path, Dict[str, str], Optional[Shard]]
+
+
 class Folders:
     def __init__(self, root: Path):
         self.ROOT = root
@@ -29,6 +54,8 @@ class Folders:
         self.SRC_PROCESSING = src/"data-processing"
         self.SRC_ANALYSIS = src/"analysis"
 
+        self.STATE = root/".compendium"  # local (not versioned) state such as caches and indices
+
 
 def find_root(folder: Path) -> Path:
     if folder is None:
@@ -39,6 +66,16 @@ def find_root(folder: Path) -> Path:
     raise FileNotFoundError(f"Cannot find compendium folder (starting from {folder})")
 
 
+def get_compendium(folder: Path = None) -> "Compendium":
+    """Get the compendium containing folder (default: the current folder), creating it only once per process"""
+    return _get_compendium(find_root(folder or Path.cwd()))
+
+
+@lru_cache(maxsize=None)
+def _get_compendium(root: Path) -> "Compendium":
+    return Compendium(root)
+
+
 class Compendium:
     def __init__(self, folder: Path = None, create_new_config=False):
         if folder is None:
@@ -49,10 +86,15 @@ class Compendium:
             self.root = folder
         else:
             self.changed = False
-            self.root = find_root(folder)
+            with instrument.span("find_root"):
+                self.root = find_root(folder)
             logging.info(f"Reading configuration file {self.root / CONFIGFILE}")
-            self.cf.read(self.root / CONFIGFILE)
+            with instrument.span("config"):
+                self.cf.read(self.root / CONFIGFILE)
         self.folders = Folders(self.root)
+        self._actions = None
+        self._encrypted = None
+        self._watched = set()
 
     # **** Configuration file management ****
 
@@ -82,10 +124,31 @@ class Compendium:
     def salt(self) -> str:
         salt = self.get(section="encryption", option="salt")
         if not salt:
-            salt = crypt.mksalt()
+            from compendium.encryption import KDF
+            salt = secrets.token_urlsafe(16)
             self.set("encryption", "salt", salt)
+            self.set("encryption", "kdf", str(KDF()))
         return salt
 
+    @property
+    def kdf(self) -> "KDF":
+        """The key derivation function and its parameters (compendia without kdf option use the original default)"""
+        from compendium.encryption import KDF
+        kdf = self.get("encryption", "kdf")
+        return KDF.parse(kdf) if kdf else KDF()
+
+    @kdf.setter
+    def kdf(self, kdf: "KDF"):
+        self.set("encryption", "kdf", str(kdf))
+
+    @property
+    def cache(self) -> Optional[ArtifactCache]:
+        """The artifact cache configured in the [cache] section, if any"""
+        folder = self.get("cache", "folder")
+        if folder:
+            max_size = self.get("cache", "max_size")
+            return ArtifactCache(self.root / Path(folder).expanduser(), parse_size(max_size) if max_size else None)
+
     @property
     def pyenv(self) -> Path:
         env = self.cf.get("python", "env", fallback=None)
@@ -96,46 +159,333 @@ class Compendium:
     def pyenv(self, env: Path):
         self.set("python", "env", str(env.relative_to(self.root)))
 
+    @property
+    def env_store(self) -> Optional[Path]:
+        """
+        The shared store of python environments and wheels ([python] store, default ~/.cache/compendium), or None
+        if the environment should be installed in the compendium itself (store = none)
+        """
+        store = self.get("python", "store")
+        if store is None:
+            return Path(os.environ.get("XDG_CACHE_HOME") or "~/.cache").expanduser() / "compendium"
+        if store.strip().lower() != "none":
+            return self.root / Path(store).expanduser()
+
     def _section(self, section: str):
         if not self.cf.has_section(section):
             self.cf.add_section(section)
         return self.cf[section]
 
+    def get_list(self, section: str, option: str) -> List[str]:
+        """Get a comma- or space-separated list option"""
+        value = self.get(section, option)
+        return [x for x in re.split("[ ,]+", value.strip()) if x] if value else []
+
+    # **** File discovery ****
+
+    def walk(self, folder: Path, suffix=None, data=False) -> Iterable[os.DirEntry]:
+        """
+        Recursively yield the files in folder, using the include and exclude patterns for scripts from the [files]
+        section, or (if data is True) for private data from the [data] section. For compatibility, the data uses the
+        exclude patterns from [files] if there is no exclude option in [data]
+        """
+        if not folder.is_dir():
+            logging.warning(f"{folder} does not exist or is not a directory")
+            return []
+        if data:
+            include = self.get_list("data", "include")
+            exclude = self.get_list("data" if self.cf.has_option("data", "exclude") else "files", "exclude")
+        else:
+            include, exclude = self.get_list("files", "include"), self.get_list("files", "exclude")
+        return walk_files(folder, suffix, include=include, exclude=exclude)
+
+    def private_files(self) -> List[Path]:
+        """Get all private (decrypted) files"""
+        with instrument.span("discovery"):
+            return [Path(entry.path) for entry in self.walk(self.folders.DATA_PRIVATE, data=True)]
+
+    def encrypted_files(self, cached=False) -> List[Path]:
+        """
+        Get all encrypted files (skipping hidden files such as the manifest). If cached, use the task index, and
+        only look for the files once per Compendium (as the doit tasks do)
+        """
+        if cached:
+            if self._encrypted is None:
+                self._load_tasks()
+            return self._encrypted
+        if not self.folders.DATA_ENCRYPTED.is_dir():
+            return []
+        with instrument.span("discovery"):
+            return [Path(entry.path) for entry in self.walk(self.folders.DATA_ENCRYPTED, data=True)]
+
+    def encrypted_path(self, private: Path) -> Path:
+        """Get the location of the encrypted version of a private file"""
+        return self.folders.DATA_ENCRYPTED / private.relative_to(self.folders.DATA_PRIVATE)
+
+    def decrypted_path(self, encrypted: Path) -> Path:
+        """Get the location of the decrypted version of an encrypted file"""
+        return self.folders.DATA_PRIVATE / encrypted.relative_to(self.folders.DATA_ENCRYPTED)
+
     # **** Tasks and actions ****
 
-    def get_actions(self) -> Iterable[Action]:
-        """Yield all processing and analysis scripts"""
-        files = (get_files(self.folders.SRC_PROCESSING, suffix=EXT_SCRIPT) +
-                 get_files(self.folders.SRC_ANALYSIS, suffix=EXT_SCRIPT))
-        for file in files:
-            headers = dict(get_headers(file))
-            if "CREATES" in headers and "COMMAND" in headers:
-                targets = parse_files(headers["CREATES"])
-                inputs = parse_files(headers.get("DEPENDS"))
-                # build action
-                action = f"{headers['COMMAND']} {file}"
-                if headers.get("PIPE", "F")[0].lower() == "t":
-                    if len(inputs) > 1 or len(targets) > 1:
-                        raise ValueError("File {file}: Cannot use PIPE with multiple inputs or outputs")
-                    if inputs:
-                        action = f"{action} < {inputs[0]}"
-                    action = f"{action} > {targets[0]}"
-                if file.suffix == ".py" and self.pyenv:
-                    # Activate virtual environent before calling script
-                    action = f"(. {self.pyenv}/bin/activate; {action})"
-                action = f'{action} && echo "[OK] {file.name} completed" 1>&2'
-                yield Action(file, action, targets, inputs, headers)
+    def get_actions(self) -> List[Action]:
+        """Get all processing and analysis scripts (the scripts are only parsed once per Compendium)"""
+        if self._actions is None:
+            self._load_tasks()
+        return self._actions
+
+    def _load_tasks(self):
+        """Get the actions and encrypted files from the task index, or find them and update the index"""
+        index = TaskIndex(self.folders.STATE/"tasks.json", self.root, self.root/CONFIGFILE,
+                          sources=[self.folders.SRC_PROCESSING, self.folders.SRC_ANALYSIS],
+                          folders=[self.folders.DATA_ENCRYPTED])
+        with instrument.span("task index"):
+            cached = index.load()
+        if cached:
+            self._actions, self._encrypted = cached
+            return
+        with instrument.span("task index"):
+            stamp = index.stamp()
+        self._actions = list(self._parse_actions())
+        self._encrypted = self.encrypted_files()
+        with instrument.span("task index"):
+            index.save(stamp, self._watched, self._actions, self._encrypted)
+
+    def _parse_actions(self) -> Iterable[Action]:
+        with instrument.span("headers"):
+            index = HeaderIndex(self.folders.STATE/"headers.json", self.root)
+        scripts = []
+        for folder in self.folders.SRC_PROCESSING, self.folders.SRC_ANALYSIS:
+            with instrument.span("discovery"):
+                entries = list(self.walk(folder, suffix=EXT_SCRIPT))
+            for entry in entries:
+                file = Path(entry.path)
+                with instrument.span("headers"):
+                    headers = dict(index.get_headers(file, entry.stat()))
+                if "FOREACH" in headers and "COMMAND" in headers:
+                    if "CREATES" in headers:
+                        raise ValueError(f"File {file}: Cannot use CREATES with FOREACH")
+                    # adding or removing an input file adds or removes a shard, so watch the input folder
+                    self._watched.add(self.root/glob_base(headers["FOREACH"].partition("->")[0].strip()))
+                    try:
+                        with instrument.span("discovery"):
+                            shards = parse_foreach(headers["FOREACH"], self.root)
+                    except ValueError as e:
+                        raise ValueError(f"File {file}: {e}")
+                    scripts += [(folder, file, headers, shard) for shard in shards]
+                elif "CREATES" in headers and "COMMAND" in headers:
+                    scripts.append((folder, file, headers, None))
+        with instrument.span("headers"):
+            index.save()
+        stored = self._stored_names(scripts)
+        for folder, file, headers, shard in scripts:
+            yield self._make_action(folder, file, headers, shard, stored)
+
+    @staticmethod
+    def _script_files(headers: Dict[str, str], shard: Optional[Shard]) -> Tuple[List[Path], List[Path]]:
+        """Get the targets and inputs of a script, or of one shard of a FOREACH script"""
+        targets = parse_files(headers.get("CREATES"))
+        inputs = parse_files(headers.get("DEPENDS"))
+        if shard:
+            inputs.append(shard[0])
+            targets.append(shard[1])
+        return targets, inputs
+
+    def _stored_names(self, scripts: List[Script]) -> Dict[Path, Tuple[Path, str]]:
+        """
+        Get the stored (compressed) name and codec of the intermediate files that are compressed, by the
+        name in the CREATES header and by the stored name. The targets of PIPE actions in the intermediate folder are
+        compressed if the script has a COMPRESS header, or by default if compress is set in the [files] section,
+        unless they are used by a script that is not a PIPE script (which reads the file itself)
+        """
+        default = self.get("files", "compress", "none")
+        plain = set()
+        for _folder, file, headers, shard in scripts:
+            if headers.get("PIPE", "F")[0].lower() != "t":
+                plain.update(self._script_files(headers, shard)[1])
+        result = {}
+        for _folder, file, headers, shard in scripts:
+            codec = headers.get("COMPRESS", default).strip().lower()
+            if codec == "none" or headers.get("PIPE", "F")[0].lower() != "t":
+                continue
+            if codec not in CODECS:
+                raise ValueError(f"File {file}: Unknown compression {codec}, use one of {', '.join(CODECS)} or none")
+            for target in self._script_files(headers, shard)[0]:
+                if target in plain:
+                    logging.debug(f"Not compressing {target}, it is used by a script that is not a PIPE script")
+                elif contained_in(self.folders.DATA_INTERMEDIATE, self.root/target):
+                    stored = target.with_name(target.name + CODECS[codec][0])
+                    result[target] = result[stored] = (stored, codec)
+        return result
+
+    def _make_action(self, folder: Path, file: Path, headers: Dict[str, str], shard: Optional[Shard],
+                     stored: Dict[Path, Tuple[Path, str]]) -> Action:
+        targets, inputs = self._script_files(headers, shard)
+        targets = [stored.get(f, (f, None))[0] for f in targets]
+        inputs = [stored.get(f, (f, None))[0] for f in inputs]
+        name = file.relative_to(folder).as_posix()
+        # build action
+        command = f"{headers['COMMAND']} {file}"
+        pipe = headers.get("PIPE", "F")[0].lower() == "t"
+        if shard:
+            name = f"{name}[{shard[2]}]"
+            if not pipe:
+                # pass the input and target of the shard as arguments
+                command = f"{command} {inputs[-1]} {targets[-1]}"
+        if file.suffix == ".py" and self.pyenv:
+            # Activate virtual environent before calling script
+            command = f"(. {self.pyenv}/bin/activate; {command})"
+        action, codecs = command, (None, None)
+        if pipe:
+            if len(inputs) > 1 or len(targets) > 1:
+                raise ValueError(f"File {file}: Cannot use PIPE with multiple inputs or outputs")
+            codecs = (stored.get(inputs[0], (None, None))[1] if inputs else None,
+                      stored.get(targets[0], (None, None))[1])
+            if inputs:
+                action = f"{CODECS[codecs[0]][2]} < {inputs[0]} | {action}" if codecs[0] else f"{action} < {inputs[0]}"
+            action = f"{action} | {CODECS[codecs[1]][1]} > {targets[0]}" if codecs[1] else f"{action} > {targets[0]}"
+        action = f'{action} && echo "[OK] {name if shard else file.name} completed" 1>&2'
+        return Action(file, action, targets, inputs, headers, name, command if pipe else None, codecs)
+
+    def run_action(self, action: Action, env: Dict[str, str] = None, key: bytes = None) -> bool:
+        """
+        Run an action (with environment env, if given), restoring the outputs from the artifact cache if possible.
+        The resource usage is recorded in the run log. Returns whether the outputs were restored from the cache,
+        raises CalledProcessError if the action failed (after removing its targets). If key is given, the private input of a PIPE action is
+        decrypted into its stdin (see run_pipeline), without using the artifact cache
+        """
+        runlog = RunLog(self.folders.STATE/RUNLOG)
+        cache = self.cache if key is None else None
+        if cache:
+            start = time.perf_counter()
+            digests = DigestIndex(self.folders.STATE/"digests.json")
+            cache_key = cache.get_key(self.root, action, digests)
+            digests.save()
+            targets = [self.root/t for t in action.targets]
+            if cache.restore(cache_key, targets):
+                print(f"[CACHED] {action.name} restored from cache", file=sys.stderr)
+                runlog.record(action.name, "cached", Usage(time.perf_counter() - start, 0.0, 0, 0, 0))
+                return True
+        for target in action.targets:
+            (self.root/target).parent.mkdir(parents=True, exist_ok=True)
+        if action.command is not None:
+            # PIPE actions are run as pipeline, so (de)compression and failures of each process are handled
+            self.run_pipeline([action], envs=[env] if env else None, key=key)
+        else:
+            returncode, usage = run_measured(action.action, cwd=self.root, env=env)
+            runlog.record(action.name, "ok" if returncode == 0 else "failed", usage)
+            if returncode != 0:
+                # the script may have written (part of) its targets, which should not look up to date
+                for target in action.targets:
+                    if (self.root/target).is_file():
+                        (self.root/target).unlink()
+                raise subprocess.CalledProcessError(returncode, action.action)
+        if cache:
+            cache.store(cache_key, targets)
+        return False
+
+    def run_pipeline(self, actions: List[Action], envs: List[Dict[str, str]] = None, key: bytes = None):
+        """
+        Run a chain of PIPE actions as a single pipeline, streaming the output of each action to the next without
+        writing the intermediate files. The input of the first action is decompressed and the target of the last
+        action is compressed as needed. If key is given and the input is a private file, the encrypted file is
+        decrypted straight into the pipeline, so the plaintext is never written to disk.
+        The resource usage of each action is recorded in the run log. The artifact cache is not used.
+        Raises CalledProcessError if any of the actions failed, or InvalidToken if the input cannot be decrypted.
+        In both cases, the (partial) output is removed
+        """
+        runlog = RunLog(self.folders.STATE/RUNLOG)
+        stdin = self.root/actions[0].inputs[0] if actions[0].inputs else None
+        stdout = self.root/actions[-1].targets[0]
+        stdout.parent.mkdir(parents=True, exist_ok=True)  # e.g. the subfolder of FOREACH targets
+        if key is not None and stdin is not None and contained_in(self.folders.DATA_PRIVATE, stdin):
+            from compendium.encryption import iter_decrypted
+            stdin = iter_decrypted(key, self.encrypted_path(stdin))
+        cmds, envs = [a.command for a in actions], list(envs) if envs else [None] * len(actions)
+        decompress, compress = actions[0].codecs[0], actions[-1].codecs[1]
+        if decompress:
+            cmds, envs = [CODECS[decompress][2]] + cmds, [None] + envs
+        if compress:
+            cmds, envs = cmds + [CODECS[compress][1]], envs + [None]
+        try:
+            returncodes, usages = run_pipeline(cmds, stdin, stdout, cwd=self.root, envs=envs)
+        except Exception:
+            try:
+                stdout.unlink()  # the output of an incomplete input should not look up to date
+            except FileNotFoundError:
+                pass
+            raise
+        # count the (de)compression as part of the first and last action
+        if decompress:
+            code, usage = returncodes.pop(0), usages.pop(0)
+            returncodes[0], usages[0] = returncodes[0] or code, usages[0].combine(usage)
+        if compress:
+            code, usage = returncodes.pop(), usages.pop()
+            returncodes[-1], usages[-1] = returncodes[-1] or code, usages[-1].combine(usage)
+        for action, returncode, usage in zip(actions, returncodes, usages):
+            runlog.record(action.name, "ok" if returncode == 0 else "failed", usage)
+        failed = [(a, code) for (a, code) in zip(actions, returncodes) if code != 0]
+        for action, returncode in failed:
+            logging.debug(f"{action.name} in pipeline exited with exit code {returncode}")
+        # if an action fails, the actions before it fail on the closed pipe, so report the last failure
+        if failed:
+            try:
+                stdout.unlink()  # a partial output should not look up to date
+            except FileNotFoundError:
+                pass
+            raise subprocess.CalledProcessError(failed[-1][1], failed[-1][0].command)
+        print(f"[OK] {' | '.join(a.name for a in actions)} completed", file=sys.stderr)
+
+    def run_action_task(self, action: Action):
+        """Run an action as doit task"""
+        from doit.exceptions import TaskFailed
+        try:
+            self.run_action(action)
+        except subprocess.CalledProcessError as e:
+            return TaskFailed(f"{action.name} failed with exit code {e.returncode}")
+
+    def get_key(self, password: str) -> bytes:
+        """Get the encryption key for this password (derived only once per process)"""
+        from compendium.encryption import get_key
+        return get_key(self.salt, password, self.kdf)
 
     def decrypt_file_task(self, password: str, source: Path, target: Path):
+        from cryptography.fernet import InvalidToken
+        from doit.exceptions import TaskFailed
+        from compendium.encryption import decrypt_file
         if password is None:
             return TaskFailed("No passphrase specified; please use doit passphrase=**** decrypt")
-        target.parent.mkdir(exist_ok=True)
-        key = get_key(self.salt, password)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        key = self.get_key(password)
         try:
-            decrypt_file(key, source, target)
+            with instrument.span("crypto"):
+                decrypt_file(key, source, target)
         except InvalidToken:
             return TaskFailed("Incorrect password, could not decrypt files")
 
+    def decrypt_all(self, password: str, jobs: int = None, overwrite: bool = False):
+        """Decrypt all encrypted files (that were not decrypted yet) using a pool of jobs processes"""
+        from compendium.encryption import decrypt_file, map_files
+        key = self.get_key(password)
+        files = [(inf, self.decrypted_path(inf)) for inf in self.encrypted_files()]
+        files = [(inf, outf) for (inf, outf) in files if overwrite or not outf.exists()]
+        if not files:
+            logging.info("All encrypted files are already decrypted")
+            return
+        for folder in {outf.parent for (_inf, outf) in files}:
+            folder.mkdir(parents=True, exist_ok=True)
+        nbytes = sum(inf.stat().st_size for (inf, _outf) in files)
+        logging.info(f"Decrypting {len(files)} file(s) to {self.folders.DATA_PRIVATE}")
+        start = time.perf_counter()
+        for inf, outf, _, _seconds in map_files(decrypt_file, key, files, jobs or os.cpu_count()):
+            logging.debug(f".. {inf} -> {outf}")
+        logging.info(f"Decrypting done: {format_throughput(nbytes, time.perf_counter() - start)}")
+
     def install_python_task(self):
         from compendium.initsegment.pyenv import install_pyvenv
-        install_pyvenv(self.pyenv)
\ No newline at end of file
+        install_pyvenv(self.pyenv, self.env_store)
+
+    def python_env_uptodate(self) -> bool:
+        """Is the python environment installed for the current requirements.txt, setup.py and python version?"""
+        from compendium.initsegment.pyenv import env_uptodate
+        return env_uptodate(self.pyenv)
\ No newline at end of file
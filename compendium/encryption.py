@@ -1,43 +1,388 @@
+"""
+Encryption of private data files
+
+Files are encrypted in a chunked streaming format, so memory use is bounded by the chunk size regardless of the
+file size. Each chunk is authenticated together with its index and a 'final' flag, so reordered, duplicated or
+truncated chunks are detected. The format is recognized by the MAGIC header and version byte:
+
+- Version 2 (current): MAGIC + version byte + chunk size (4 bytes) + random file salt (16 bytes), followed by
+  the chunks, each encrypted with AES-256-GCM (adding a 16 byte tag). The key for each file is derived from the
+  (compendium) key and the file salt using HKDF, and the nonce of each chunk is its index followed by the final
+  flag, so a nonce is never reused. All chunks except the last have the full chunk size, so no framing is needed.
+- Version 1: MAGIC + version byte, followed by frames of [4 byte length][Fernet token], where the plaintext of
+  each token is prefixed by the chunk index and final flag. Fernet tokens are base64, i.e. 33% larger.
+- Legacy: files without the MAGIC header are a single Fernet token.
+
+Versions 1 and legacy can still be decrypted, use encrypt --upgrade to convert them to the current version.
+"""
 import base64
+import hashlib
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator, BinaryIO, Dict, Tuple, Callable, Sequence, Any, Optional, Iterable, NamedTuple
 
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+from compendium import instrument
+
+# Fernet tokens are urlsafe base64 and start with 'gAAAAA', so they can never start with this header
+MAGIC = b"\x89CCS"
+VERSION_LEGACY = 0
+VERSION_STREAM = 1
+VERSION_AEAD = 2
+CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+
+_FRAME = struct.Struct(">I")
+_CHUNK = struct.Struct(">QB")
+_AEAD_HEADER = struct.Struct(">I16s")  # chunk size, file salt
+_NONCE = struct.Struct(">xxxQB")  # 12 bytes: chunk index, final flag
+_TAG_SIZE = 16
+
+
+
+class KDF(NamedTuple):
+    """
+    Key derivation function and its cost parameters, stored in the configuration as e.g. 'scrypt n=16384 r=8 p=1'.
+    The default (PBKDF2 with 100,000 iterations) is used for compendia without stored parameters
+    """
+    algorithm: str = "pbkdf2"
+    iterations: int = 100_000  # pbkdf2 and argon2id
+    n: int = 2 ** 14  # scrypt CPU/memory cost
+    r: int = 8  # scrypt block size
+    p: int = 1  # scrypt parallelism
+    memory: int = 64 * 1024  # argon2id memory in KiB
+    lanes: int = 4  # argon2id parallelism
+
+    def __str__(self):
+        return " ".join([self.algorithm] + [f"{name}={getattr(self, name)}" for name in KDF_PARAMETERS[self.algorithm]])
+
+    @classmethod
+    def parse(cls, text: str) -> "KDF":
+        if not text.split():
+            raise ValueError(f"Empty key derivation function, use one of {', '.join(KDF_PARAMETERS)}")
+        algorithm, *params = text.split()
+        if algorithm not in KDF_PARAMETERS:
+            raise ValueError(f"Unknown key derivation function {algorithm}, use one of {', '.join(KDF_PARAMETERS)}")
+        values = {}
+        for param in params:
+            name, _, value = param.partition("=")
+            if name not in KDF_PARAMETERS[algorithm] or not value.isdigit():
+                raise ValueError(f"Invalid parameter {param!r} for {algorithm}, "
+                                 f"use {' '.join(n + '=...' for n in KDF_PARAMETERS[algorithm])}")
+            values[name] = int(value)
+        kdf = cls(algorithm, **values)
+        kdf.validate()
+        return kdf
+
+    def validate(self):
+        """Raise a ValueError if the parameters are not accepted by the key derivation function"""
+        if self.algorithm == "scrypt":
+            if self.n < 2 or self.n & (self.n - 1):
+                raise ValueError(f"scrypt n should be a power of two larger than 1, not {self.n}")
+            if self.r < 1 or self.p < 1:
+                raise ValueError("scrypt r and p should be at least 1")
+        elif self.iterations < 1:
+            raise ValueError(f"{self.algorithm} iterations should be at least 1")
+        elif self.algorithm == "argon2id":
+            if self.lanes < 1:
+                raise ValueError("argon2id lanes should be at least 1")
+            if self.memory < 8 * self.lanes:
+                raise ValueError(f"argon2id memory should be at least 8 KiB per lane, i.e. {8 * self.lanes}")
+
+
+KDF_PARAMETERS = {
+    "pbkdf2": ["iterations"],
+    "scrypt": ["n", "r", "p"],
+    "argon2id": ["iterations", "memory", "lanes"],
+}
+
+# Derived keys, indexed by salt, key derivation function and password digest. Only kept in memory for this process
+_KEYS: Dict[Tuple[str, str, bytes], bytes] = {}
+
+
+def get_key(salt: str, password: str, kdf: KDF = KDF()) -> bytes:
+    """Get the key for this salt and password, only running the key derivation once per process"""
+    index = (salt, str(kdf), hashlib.sha256(password.encode("utf-8")).digest())
+    key = _KEYS.get(index)
+    if key is None:
+        key = _KEYS[index] = derive_key(salt, password, kdf)
+    return key
+
+
+def derive_key(salt: str, password: str, kdf: KDF = KDF()) -> bytes:
+    salt, password = salt.encode("utf-8"), password.encode("utf-8")
+    if kdf.algorithm == "pbkdf2":
+        # From: https://cryptography.io/en/latest/hazmat/primitives/key-derivation-functions/#nist
+        function = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=kdf.iterations)
+    elif kdf.algorithm == "scrypt":
+        function = Scrypt(salt=salt, length=32, n=kdf.n, r=kdf.r, p=kdf.p)
+    elif kdf.algorithm == "argon2id":
+        try:
+            from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+        except ImportError:
+            raise ValueError("argon2id needs cryptography 44 or later, please upgrade (pip install -U cryptography)")
+        function = Argon2id(salt=salt, length=32, iterations=kdf.iterations, lanes=kdf.lanes,
+                            memory_cost=kdf.memory)
+    else:
+        raise ValueError(f"Unknown key derivation function {kdf.algorithm}")
+    with instrument.span("kdf"):
+        return base64.urlsafe_b64encode(function.derive(password))
+
+
+def calibrate(algorithm: str, seconds: float) -> KDF:
+    """Choose the cost parameters of the algorithm so deriving a key takes about the given time on this machine"""
+    def timed(kdf: KDF) -> float:
+        start = time.perf_counter()
+        derive_key("calibration-salt", "calibration-password", kdf)
+        return time.perf_counter() - start
+    if algorithm == "pbkdf2":
+        kdf = KDF(algorithm, iterations=100_000)
+        return kdf._replace(iterations=max(10_000, int(round(kdf.iterations * seconds / timed(kdf), -3))))
+    if algorithm == "scrypt":
+        # the memory use (128 * n * r bytes) grows with n, so double n up to 1 GiB
+        kdf = KDF(algorithm, n=2 ** 14)
+        duration = timed(kdf)
+        while duration * 2 <= seconds and kdf.n < 2 ** 20:
+            kdf = kdf._replace(n=kdf.n * 2)
+            duration *= 2
+        return kdf
+    if algorithm == "argon2id":
+        kdf = KDF(algorithm, iterations=1)
+        return kdf._replace(iterations=max(1, round(seconds / timed(kdf))))
+    raise ValueError(f"Unknown key derivation function {algorithm}, use one of {', '.join(KDF_PARAMETERS)}")
+
+
+def verify_file(key: bytes, infile: Path, outfile: Path) -> bool:
+    """Is outfile an encryption of infile? Compares chunk by chunk, stopping at the first difference"""
+    try:
+        with infile.open('rb') as f:
+            for chunk in iter_decrypted(key, outfile):
+                if f.read(len(chunk)) != chunk:
+                    return False
+            return not f.read(1)
+    except InvalidToken:
+        return False
+
+
+def file_version(file: Path) -> int:
+    """Get the format version of an encrypted file"""
+    with file.open('rb') as f:
+        header = f.read(len(MAGIC) + 1)
+    return header[len(MAGIC)] if header.startswith(MAGIC) and len(header) > len(MAGIC) else VERSION_LEGACY
 
 
-def get_key(salt: str, password: str) -> bytes:
-    # From: https://cryptography.io/en/latest/hazmat/primitives/key-derivation-functions/#nist
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt.encode("utf-8"),
-        iterations=100000
-    )
-    return base64.urlsafe_b64encode(kdf.derive(password.encode("utf-8")))
+def read_decrypted(key: bytes, file: Path) -> bytes:
+    """Decrypt file into memory. Use iter_decrypted for large files"""
+    return b"".join(iter_decrypted(key, file))
 
 
-def verify_file(key: bytes, infile: Path, outfile: Path):
-    decrypted = read_decrypted(key, outfile)
-    plaintext = infile.open('rb').read()
-    return decrypted == plaintext
+def iter_decrypted(key: bytes, file: Path) -> Iterator[bytes]:
+    """Yield the decrypted contents of file in chunks, raising InvalidToken if it cannot be decrypted"""
+    with file.open('rb') as f:
+        header = f.read(len(MAGIC) + 1)
+        if not header.startswith(MAGIC):
+            # Legacy format: the whole file is a single Fernet token
+            yield Fernet(key).decrypt(header + f.read())
+            return
+        version = header[len(MAGIC)]
+        if version == VERSION_AEAD:
+            yield from _decrypt_aead(key, header, f)
+        elif version == VERSION_STREAM:
+            yield from _decrypt_frames(Fernet(key), f)
+        else:
+            raise InvalidToken(f"Unknown encryption format version {version} in {file}")
 
 
-def read_decrypted(key: bytes, file: Path):
-    fernet = Fernet(key)
-    ciphertext = file.open('rb').read()
-    return fernet.decrypt(ciphertext)
+def _decrypt_frames(fernet: Fernet, f: BinaryIO) -> Iterator[bytes]:
+    expected = 0
+    while True:
+        length = f.read(_FRAME.size)
+        if len(length) != _FRAME.size:
+            raise InvalidToken("Encrypted file is truncated")
+        token = f.read(_FRAME.unpack(length)[0])
+        plaintext = fernet.decrypt(token)
+        index, final = _CHUNK.unpack_from(plaintext)
+        if index != expected:
+            raise InvalidToken(f"Encrypted file is corrupted: expected chunk {expected}, got {index}")
+        yield plaintext[_CHUNK.size:]
+        if final:
+            if f.read(1):
+                raise InvalidToken("Encrypted file contains data after the final chunk")
+            return
+        expected += 1
+
+
+def _file_cipher(key: bytes, salt: bytes) -> AESGCM:
+    """The cipher for a file: the key is derived from the compendium key and the file salt"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b"ccs-aead-v2")
+    return AESGCM(hkdf.derive(base64.urlsafe_b64decode(key)))
+
+
+def _decrypt_aead(key: bytes, header: bytes, f: BinaryIO) -> Iterator[bytes]:
+    params = f.read(_AEAD_HEADER.size)
+    if len(params) != _AEAD_HEADER.size:
+        raise InvalidToken("Encrypted file is truncated")
+    chunk_size, salt = _AEAD_HEADER.unpack(params)
+    cipher, aad = _file_cipher(key, salt), header + params
+    index, block = 0, f.read(chunk_size + _TAG_SIZE)
+    while True:
+        # read ahead to know whether this is the final chunk (a truncated file fails to decrypt, as its last
+        # chunk was not encrypted as final chunk)
+        next_block = f.read(chunk_size + _TAG_SIZE)
+        final = not next_block
+        try:
+            yield cipher.decrypt(_NONCE.pack(index, final), block, aad)
+        except InvalidTag:
+            raise InvalidToken(f"Encrypted file is corrupted, truncated, or the password is incorrect "
+                               f"(chunk {index})")
+        if final:
+            return
+        index, block = index + 1, next_block
 
 
 def decrypt_file(key: bytes, infile: Path, outfile: Path):
     """Decrypt infile and save as outfile"""
-    plaintext = read_decrypted(key, infile)
-    outfile.open('wb').write(plaintext)
+    with _atomic_open(outfile) as out:
+        for chunk in iter_decrypted(key, infile):
+            out.write(chunk)
+
+
+def encrypt_file(key: bytes, infile: Path, outfile: Path, chunk_size: int = CHUNK_SIZE) -> str:
+    """Encrypt infile and save as outfile, returning the digest of the encrypted file"""
+    with infile.open('rb') as f:
+        return _encrypt(key, f.read, outfile, chunk_size)
+
+
+def upgrade_file(key: bytes, infile: Path, outfile: Path, chunk_size: int = CHUNK_SIZE,
+                 new_key: bytes = None) -> Tuple[str, str]:
+    """
+    Encrypt the (decrypted) contents of encrypted file infile in the current format (with new_key, if given),
+    and save as outfile (which can be infile itself).
+    Returns the keyed digest of the plaintext and the digest of the encrypted file
+    """
+    new_key = new_key or key
+    digest = _keyed_digest(new_key)
+
+    def chunks() -> Iterator[bytes]:
+        for chunk in iter_decrypted(key, infile):
+            digest.update(chunk)
+            yield chunk
+    encrypted = _encrypt(new_key, _Reader(chunks()).read, outfile, chunk_size)
+    return digest.hexdigest(), encrypted
+
+
+def _encrypt(key: bytes, read: Callable[[int], bytes], outfile: Path, chunk_size: int) -> str:
+    """Encrypt the data returned by read(n) and save as outfile, returning the digest of the encrypted file"""
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    salt = os.urandom(16)
+    header = MAGIC + bytes([VERSION_AEAD]) + _AEAD_HEADER.pack(chunk_size, salt)
+    cipher = _file_cipher(key, salt)
+    with _atomic_open(outfile) as out:
+        def write(data: bytes):
+            digest.update(data)
+            out.write(data)
+        write(header)
+        index, chunk = 0, read(chunk_size)
+        while True:
+            # read ahead so the final chunk can be marked as such
+            next_chunk = read(chunk_size)
+            final = not next_chunk
+            write(cipher.encrypt(_NONCE.pack(index, final), chunk, header))
+            if final:
+                break
+            index, chunk = index + 1, next_chunk
+    return digest.hexdigest()
+
+
+class _Reader:
+    """File-like read(n) over an iterator of chunks of any size"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer, self.pos = b"", 0
+
+    def read(self, n: int) -> bytes:
+        while len(self.buffer) - self.pos < n:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer, self.pos = self.buffer[self.pos:] + chunk, 0
+        data = self.buffer[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+
+def file_digest(file: Path, key: bytes = None) -> str:
+    """
+    Compute the (fast) blake2b digest of a file. If key is given, a keyed digest is computed,
+    so the digest of a private file does not allow anyone without the key to guess its contents
+    """
+    digest = _keyed_digest(key)
+    with file.open('rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _keyed_digest(key: Optional[bytes]):
+    """A blake2b digest object, keyed with a key derived from the encryption key (if given)"""
+    if key is not None:
+        key = hashlib.blake2b(base64.urlsafe_b64decode(key), person=b"ccs-manifest").digest()
+    return hashlib.blake2b(digest_size=DIGEST_SIZE, key=key or b"")
+
+
+def file_digests(key: bytes, infile: Path, outfile: Path) -> Tuple[str, Optional[str]]:
+    """Return the keyed digest of the plaintext infile and the digest of the encrypted outfile (if it exists)"""
+    return file_digest(infile, key), (file_digest(outfile) if outfile.exists() else None)
+
+
+@contextmanager
+def _atomic_open(file: Path):
+    """Write to a temporary file that replaces file only if writing succeeded"""
+    tmp = file.with_name(f".{file.name}.tmp")
+    try:
+        with tmp.open('wb') as f:
+            yield f
+        os.replace(tmp, file)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def map_files(function: Callable[[bytes, Path, Path], Any], key: bytes, files: Sequence[Tuple[Path, Path]],
+              jobs: int = 1) -> Iterator[Tuple[Path, Path, Any, float]]:
+    """
+    Call function(key, infile, outfile) on each pair of files, using a pool of processes if jobs > 1.
+    Yields (infile, outfile, result, seconds) tuples in order of completion.
+    """
+    if jobs <= 1 or len(files) <= 1:
+        for infile, outfile in files:
+            result, seconds = _timed(function, key, infile, outfile)
+            instrument.add("crypto", seconds)
+            yield infile, outfile, result, seconds
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_timed, function, key, infile, outfile): (infile, outfile)
+                   for (infile, outfile) in files}
+        for future in as_completed(futures):
+            infile, outfile = futures[future]
+            result, seconds = future.result()
+            instrument.add("crypto", seconds)  # the time in the worker processes
+            yield infile, outfile, result, seconds
 
 
-def encrypt_file(key: bytes, infile: Path, outfile: Path):
-    """Encrypt infile and save as outfile"""
-    fernet = Fernet(key)
-    plaintext = infile.open('rb').read()
-    ciphertext = fernet.encrypt(plaintext)
-    outfile.open('wb').write(ciphertext)
+def _timed(function: Callable[[bytes, Path, Path], Any], key: bytes, infile: Path, outfile: Path) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = function(key, infile, outfile)
+    return result, time.perf_counter() - start
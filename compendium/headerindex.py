@@ -0,0 +1,62 @@
+"""
+On-disk index of script headers, so scripts are only parsed again if they changed
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Tuple, Dict
+
+from compendium.util import get_headers, write_json
+
+INDEX_VERSION = 1
+
+
+class HeaderIndex:
+    """Cache of get_headers results, keyed by path and invalidated by modification time and size"""
+
+    def __init__(self, file: Path, root: Path):
+        self.file = file
+        self.prefix = f"{root}{os.path.sep}"
+        self.entries: Dict[str, list] = {}
+        self.seen = set()
+        self.changed = False
+        try:
+            with file.open() as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION:
+                self.entries = data["entries"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug(f"Ignoring unreadable header index {file}: {e}")
+
+    def get_headers(self, file: Path, stat: os.stat_result = None) -> List[Tuple[str, str]]:
+        """Get the headers of file, parsing it only if it is not in the index or was modified"""
+        if stat is None:
+            stat = file.stat()
+        key = str(file)
+        if key.startswith(self.prefix):  # index by relative path so moving the compendium keeps the index valid
+            key = key[len(self.prefix):]
+        self.seen.add(key)
+        entry = self.entries.get(key)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            return [tuple(header) for header in entry[2]]
+        headers = list(get_headers(file))
+        self.entries[key] = [stat.st_mtime_ns, stat.st_size, headers]
+        self.changed = True
+        return headers
+
+    def save(self):
+        """Save the index if it changed, dropping entries for files that were not requested"""
+        for key in set(self.entries) - self.seen:
+            del self.entries[key]
+            self.changed = True
+        if not self.changed:
+            return
+        logging.debug(f"Writing header index {self.file}")
+        try:
+            write_json(self.file, {"version": INDEX_VERSION, "entries": self.entries})
+        except OSError as e:
+            logging.debug(f"Could not write header index {self.file}: {e}")
+        self.changed = False
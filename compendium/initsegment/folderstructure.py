@@ -1,7 +1,6 @@
 import logging
 from argparse import ArgumentParser, Namespace
 from pathlib import Path
-from urllib.request import urlretrieve
 
 from compendium.initsegment.segment import Segment
 from compendium.util import yesno
@@ -11,6 +10,7 @@ def _download(fn: str, dest: Path):
     dest.parent.mkdir(exist_ok=True)
     url = f"https://raw.githubusercontent.com/vanatteveldt/compendium-dodo/main/templates/{fn}"
     logging.info(f"Downloading {url} to {dest}")
+    from urllib.request import urlretrieve
     urlretrieve(url, dest)
 
 
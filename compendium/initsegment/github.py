@@ -4,7 +4,6 @@ import re
 from argparse import ArgumentParser, Namespace
 from pathlib import Path
 
-import requests
 import logging
 
 from compendium.compendium import Compendium, find_root, CONFIGFILE
@@ -124,6 +123,7 @@ def check_github(repository: str) -> str:
         if not re.match(r"\w+/\w+", repository):
             raise ValueError("Invalid repository name, format should be full repository URL or userame/repository")
         repository = f"https://github.com/{repository}"
+    import requests
     resp = requests.head(repository)
     if resp.status_code != 200:
         raise ValueError(
@@ -1,13 +1,21 @@
+import hashlib
 import logging
+import platform
+import shutil
 import subprocess
+import sys
 from argparse import ArgumentParser, Namespace
 
 #from compendium.command.init import find_env
 from pathlib import Path
+from typing import Optional
 
 from compendium.initsegment.segment import Segment
 from compendium.util import AbsolutePath, yesno, call
 
+# Written in the environment when it is completely installed, with the hash of the requirements
+MARKER = ".compendium-env"
+
 
 class PyEnvSegment(Segment):
     ARGS = ["python_env"]
@@ -21,8 +29,8 @@ class PyEnvSegment(Segment):
         if not args.python_env:
             return
         self.compendium.pyenv = args.python_env
-        if not args.python_env.exists():
-            install_pyvenv(args.python_env)
+        if not env_uptodate(args.python_env):
+            install_pyvenv(args.python_env, self.compendium.env_store)
 
     def interactive_arguments(self, args: Namespace):
         if not args.python_env:
@@ -44,15 +52,89 @@ def find_env(location: Path):
             return path
 
 
-def install_pyvenv(env: Path):
+def env_hash(root: Path) -> str:
+    """
+    Hash of everything that determines the python environment of a compendium: requirements.txt, setup.py and the
+    python version. As setup.py is installed in editable mode, environments with a setup.py are also keyed by root
+    """
+    h = hashlib.sha256(f"{platform.python_implementation()} {platform.python_version()} {platform.machine()}\n"
+                       f"compendium-dodo\n".encode("utf-8"))
+    for name in "requirements.txt", "setup.py":
+        file = root / name
+        if file.exists():
+            h.update(f"{name}\n".encode("utf-8"))
+            h.update(file.read_bytes())
+    if (root / "setup.py").exists():
+        h.update(str(root.resolve()).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def env_uptodate(env: Path) -> bool:
+    """
+    Is the environment installed for the current requirements? Environments installed by earlier versions (which
+    are not links and have no marker) are kept as they are, i.e. they are installed only once
+    """
+    if env.exists() and not env.is_symlink() and not (env / MARKER).exists():
+        return True
+    return _installed(env) == env_hash(env.parent)
+
+
+def _installed(env: Path) -> Optional[str]:
+    """The hash of the requirements the environment was installed for, or None if it is not (completely) installed"""
+    try:
+        return (env / MARKER).read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def install_pyvenv(env: Path, store: Path = None):
+    """
+    Install the python environment for the compendium in env.parent. If store is given, the environment is
+    built once in the store (keyed by env_hash), and env becomes a link to it, so compendia and clones with the same
+    requirements share it. Wheels are kept in the wheelhouse in store (or in .compendium if there is no store), so
+    environments can be rebuilt without downloading or building them again, also when offline.
+    """
+    import fcntl  # only on posix, so check and init also work on windows
+    root = env.parent
+    if store is None:
+        _build_env(env, root, root / ".compendium" / "wheels")
+        return
+    if env.exists() and not env.is_symlink():
+        logging.warning(f"{env} is not a link to the shared environment store, remove it to use {store}")
+        return
+    key = env_hash(root)
+    shared = store / "envs" / key
+    shared.parent.mkdir(parents=True, exist_ok=True)
+    with (store / "envs" / f"{key}.lock").open("w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # another compendium could be building the same environment
+        if _installed(shared) == key:
+            logging.info(f"Using the shared python environment {shared}")
+        else:
+            _build_env(shared, root, store / "wheels")
+    if env.is_symlink():
+        env.unlink()
+    env.symlink_to(shared, target_is_directory=True)
+
+
+def _build_env(env: Path, root: Path, wheels: Path):
+    """Create a virtual environment in env, and install the requirements of root using the wheelhouse"""
+    if env.exists():
+        shutil.rmtree(env)  # incomplete, or for other requirements
     logging.info(f"Creating Python virtual environment at {env}")
-    call(f"python3 -m venv {env}")
-    logging.debug("Installing compendium-dodo to virtual environment")
-    call(f"{env}/bin/pip install -U pip wheel")
-    call(f"{env}/bin/pip install compendium-dodo")
-    setup = env.parent/"setup.py"
-    if setup.exists():
-        call(f"{env}/bin/pip install -e {setup.parent}")
-    req = env.parent/"requirements.txt"
+    call(f"{sys.executable} -m venv {env}")
+    wheels.mkdir(parents=True, exist_ok=True)
+    packages = "pip wheel compendium-dodo"
+    req = root / "requirements.txt"
     if req.exists():
-        call(f"{env}/bin/pip install -r {req}")
+        packages = f"{packages} -r {req}"
+    try:
+        # add any missing wheels to the wheelhouse (building them if needed)
+        call(f"{env}/bin/pip wheel --quiet --wheel-dir {wheels} --find-links {wheels} {packages}")
+    except subprocess.CalledProcessError:
+        logging.warning(f"Could not download or build all wheels, trying to install from {wheels} only")
+    logging.debug("Installing compendium-dodo and the requirements to virtual environment")
+    call(f"{env}/bin/pip install --no-index --find-links {wheels} -U {packages}")
+    setup = root / "setup.py"
+    if setup.exists():
+        call(f"{env}/bin/pip install --find-links {wheels} -e {root}")
+    (env / MARKER).write_text(env_hash(root))
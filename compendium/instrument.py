@@ -0,0 +1,91 @@
+"""
+Instrumentation for `compendium --timings` and `compendium --profile`
+
+Code reports the time spent in a phase with `with span("name"):` (or `add("name", seconds)` for time measured
+elsewhere, e.g. in a worker process). Spans are only recorded after enable() is called, so they cost next to
+nothing otherwise. The same phase can be entered many times and from several threads: its total time and count
+are reported, so the times of parallel spans can add up to more than the wall time.
+"""
+import sys
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, TextIO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import cProfile
+
+_enabled = False
+_lock = threading.Lock()
+_totals: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])  # name: [seconds, count]
+_start = time.perf_counter()
+
+
+def enable():
+    """Start recording spans"""
+    global _enabled, _start
+    _enabled = True
+    _start = time.perf_counter()
+
+
+def add(name: str, seconds: float, count: int = 1):
+    """Record seconds spent in the named phase"""
+    if _enabled:
+        with _lock:
+            total = _totals[name]
+            total[0] += seconds
+            total[1] += count
+
+
+class span:
+    """Context manager that records the time spent in its body as the named phase"""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter() if _enabled else None
+        return self
+
+    def __exit__(self, *_exc):
+        if self.start is not None:
+            add(self.name, time.perf_counter() - self.start)
+
+
+def report(file: TextIO = sys.stderr):
+    """Print the total time and count of each phase, slowest first, and the wall time since enable()"""
+    wall = time.perf_counter() - _start
+    print("Timings (phases can overlap, and parallel phases are added up):", file=file)
+    for name, (seconds, count) in sorted(_totals.items(), key=lambda x: x[1][0], reverse=True):
+        print(f"  {name:<28} {seconds * 1000:10.1f}ms {count:7}x {seconds / wall:7.1%}", file=file)
+    print(f"  {'total (wall)':<28} {wall * 1000:10.1f}ms", file=file)
+
+
+def write_profile(profile: "cProfile.Profile", file: Path):
+    """
+    Write the profile to file, in callgrind format (for kcachegrind or qcachegrind) if the file name starts with
+    callgrind or ends with .callgrind, or as pstats (for python -m pstats or snakeviz) otherwise
+    """
+    import pstats
+    if file.name.startswith("callgrind") or file.suffix == ".callgrind":
+        _write_callgrind(pstats.Stats(profile).stats, file)
+    else:
+        profile.dump_stats(file)
+
+
+def _write_callgrind(stats: dict, file: Path):
+    """Write pstats data in callgrind format, with the cost in microseconds"""
+    callees = defaultdict(list)
+    for func, (_cc, _nc, _tt, _ct, callers) in stats.items():
+        for caller, (ncalls, _ccc, _ttc, cumulative) in callers.items():
+            callees[caller].append((func, ncalls, cumulative))
+    with file.open("w") as f:
+        f.write("# callgrind format\nversion: 1\ncreator: compendium --profile\nevents: Microseconds\n\n")
+        for (filename, line, name), (_cc, _nc, total, _ct, _callers) in stats.items():
+            f.write(f"fl={filename}\nfn={name}:{line}\n{line} {int(total * 1e6)}\n")
+            for (cfilename, cline, cname), ncalls, cumulative in callees[(filename, line, name)]:
+                f.write(f"cfl={cfilename}\ncfn={cname}:{cline}\ncalls={ncalls} {cline}\n"
+                        f"{line} {int(cumulative * 1e6)}\n")
+            f.write("\n")
@@ -0,0 +1,60 @@
+"""
+Manifest of encrypted files
+
+The manifest is stored next to the encrypted files and records, for each private file, a keyed digest of the
+plaintext and the digest of the encrypted file. This allows encrypt to skip files that did not change
+(which avoids re-encrypting them with a new random IV), and verify to check files without decrypting them.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Optional, Dict, Iterable, NamedTuple
+
+MANIFEST = ".manifest.json"
+
+
+class ManifestEntry(NamedTuple):
+    plaintext: str
+    encrypted: str
+
+
+class Manifest:
+    def __init__(self, folder: Path):
+        self.file = folder / MANIFEST
+        self.entries: Dict[str, ManifestEntry] = {}
+        if self.file.exists():
+            logging.debug(f"Reading manifest {self.file}")
+            with self.file.open() as f:
+                self.entries = {name: ManifestEntry(**entry) for (name, entry) in json.load(f)["files"].items()}
+        self.changed = False
+
+    def get(self, name: str) -> Optional[ManifestEntry]:
+        return self.entries.get(name)
+
+    def set(self, name: str, plaintext: str, encrypted: str):
+        entry = ManifestEntry(plaintext, encrypted)
+        if self.entries.get(name) != entry:
+            self.entries[name] = entry
+            self.changed = True
+
+    def is_current(self, name: str, plaintext: str, encrypted: Optional[str]) -> bool:
+        """Is the encrypted file an encryption of the current plaintext?"""
+        return encrypted is not None and self.get(name) == ManifestEntry(plaintext, encrypted)
+
+    def keep_only(self, names: Iterable[str]):
+        """Remove all entries not in names"""
+        names = set(names)
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+                self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        logging.debug(f"Writing manifest {self.file}")
+        entries = {name: entry._asdict() for (name, entry) in sorted(self.entries.items())}
+        with self.file.open("w") as f:
+            json.dump({"version": 1, "files": entries}, f, indent=1)
+            f.write("\n")
+        self.changed = False
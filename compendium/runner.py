@@ -0,0 +1,545 @@
+"""
+Parallel pipeline runner
+
+Builds the dependency graph of the actions, and runs the actions that are not up to date on a pool of workers.
+Of the actions whose inputs are ready, the action with the longest (estimated) remaining critical path is started
+first, using the durations of earlier runs. If an action fails, no new actions are started.
+
+Scripts can declare the resources they need with #THREADS: n and #MEMORY: size (e.g. 24G) headers.
+Actions are only started if they fit in the remaining CPU and memory budget, otherwise a lower priority action that
+does fit is started. The thread count is passed to the script in the usual environment variables (OMP_NUM_THREADS etc.),
+which scripts without #THREADS only get if several workers share the cpus (their share of the cpus).
+
+Besides the actions, decrypting the private files and installing the python environment are jobs in the same graph,
+so they run in parallel with (and before) the scripts that need them. With trace=FILE, a timeline of the run is
+written in the trace event format, which can be opened in https://ui.perfetto.dev or chrome://tracing.
+
+With fuse=True, chains of PIPE actions are run as a single shell pipeline if the intermediate file is only read by the
+next action in the chain, so it is streamed through memory rather than written to and read back from disk. Add a
+#KEEP: TRUE header to a script to always write its output to disk.
+
+Private files are only decrypted if a script that is not up to date uses them. With tmp_private=True, they are
+decrypted to a temporary folder (in memory if possible) that is removed after the run. PIPE actions with a private
+input that was not decrypted yet decrypt it straight into their stdin, so the plaintext is not written at all.
+"""
+import heapq
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import List, Dict, Set, Iterable, Optional
+
+from cryptography.fernet import InvalidToken
+
+from compendium.action import Action
+from compendium.compendium import Compendium
+from compendium.telemetry import RunLog, RUNLOG, Usage
+from compendium.util import parse_size, total_memory, format_size
+
+TMP_PREFIX = "compendium-private-"
+
+# Environment variables that limit the number of threads used by numerical libraries
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                    "VECLIB_MAXIMUM_THREADS"]
+
+
+class Job:
+    """A node in the dependency graph: something that creates its targets from its inputs"""
+    kind = "job"
+
+    def __init__(self, name: str, targets: List[Path], inputs: List[Path], threads: int = 1, memory: int = 0):
+        self.name = name
+        self.targets = targets
+        self.inputs = inputs
+        self.threads = threads
+        self.memory = memory
+        self.deps: Set["Job"] = set()
+        self.dependents: Set["Job"] = set()
+        self.duration = 0.0
+        self.priority = 0.0
+        self.status: Optional[str] = None
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.lane: Optional[int] = None
+
+    @property
+    def sources(self) -> List[Path]:
+        """The files that make the targets out of date if they are changed"""
+        return self.inputs
+
+    def is_uptodate(self) -> bool:
+        """Are all targets newer than the sources?"""
+        try:
+            oldest = min(t.stat().st_mtime_ns for t in self.targets)
+        except FileNotFoundError:
+            return False
+        return all(f.stat().st_mtime_ns <= oldest for f in self.sources if f.exists())
+
+    def execute(self, runner: "Runner") -> str:
+        """Create the targets, returning the status (ok, cached or failed)"""
+        raise NotImplementedError()
+
+    def estimate(self, durations: Dict[str, float], default: float) -> float:
+        """Estimated duration of this job, based on the durations of earlier runs"""
+        return durations.get(self.name, default)
+
+    def __lt__(self, other: "Job"):
+        return self.name < other.name
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class ActionJob(Job):
+    """Run a processing or analysis script"""
+    kind = "action"
+
+    def __init__(self, action: Action, root: Path):
+        try:
+            threads = max(1, int(action.headers.get("THREADS", 1)))
+            memory = parse_size(action.headers["MEMORY"]) if "MEMORY" in action.headers else 0
+        except ValueError as e:
+            raise ValueError(f"Invalid THREADS or MEMORY header in {action.file}: {e}")
+        super().__init__(action.name, [root/f for f in action.targets], [root/f for f in action.inputs],
+                         threads, memory)
+        self.action = action
+        self.encrypted: Optional[Path] = None  # private input that is decrypted straight into stdin, see stream_private
+
+    @property
+    def sources(self) -> List[Path]:
+        return self.inputs + [self.action.file] + ([self.encrypted] if self.encrypted else [])
+
+    def execute(self, runner: "Runner") -> str:
+        try:
+            key = runner.get_key() if self.encrypted else None
+            cached = runner.compendium.run_action(self.action, env=runner.environment(self), key=key)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"{self.name} failed with exit code {e.returncode}")
+            return "failed"
+        except (ValueError, InvalidToken) as e:
+            logging.error(f"{self.name}: could not decrypt {self.encrypted}: {str(e) or 'incorrect passphrase'}")
+            return "failed"
+        return "cached" if cached else "ok"
+
+
+class PipelineJob(Job):
+    """Run a chain of PIPE actions as a single pipeline, without writing the intermediate files"""
+    kind = "pipeline"
+
+    def __init__(self, stages: List[ActionJob]):
+        # the stages mostly wait for each other, so count the threads of the largest stage (but all memory)
+        super().__init__(" | ".join(stage.name for stage in stages), stages[-1].targets, stages[0].inputs,
+                         max(stage.threads for stage in stages), sum(stage.memory for stage in stages))
+        self.stages = stages
+
+    @property
+    def sources(self) -> List[Path]:
+        return self.stages[0].sources + [stage.action.file for stage in self.stages[1:]]
+
+    def execute(self, runner: "Runner") -> str:
+        envs = [runner.environment(stage) for stage in self.stages]
+        try:
+            key = runner.get_key() if self.stages[0].encrypted else None
+            runner.compendium.run_pipeline([stage.action for stage in self.stages], envs=envs, key=key)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"{self.name} failed: {e.cmd} exited with exit code {e.returncode}")
+            return "failed"
+        except (ValueError, InvalidToken) as e:
+            logging.error(f"{self.name}: could not decrypt {self.stages[0].encrypted}: {str(e) or 'incorrect passphrase'}")
+            return "failed"
+        return "ok"
+
+    def estimate(self, durations: Dict[str, float], default: float) -> float:
+        # the stages run concurrently, so the pipeline takes (at least) as long as its slowest stage
+        return max(stage.estimate(durations, default) for stage in self.stages)
+
+
+class DecryptJob(Job):
+    """Decrypt a private file"""
+    kind = "decrypt"
+
+    def __init__(self, compendium: Compendium, encrypted: Path):
+        decrypted = compendium.decrypted_path(encrypted)
+        super().__init__(f"decrypt:{decrypted.relative_to(compendium.root).as_posix()}", [decrypted], [encrypted])
+
+    def is_uptodate(self) -> bool:
+        # like the doit decrypt task, decrypted files are never decrypted again
+        if self.targets[0].exists():
+            return True
+        # the file is not needed if all scripts that use it are up to date (e.g. with a temporary private folder)
+        encrypted = self.inputs[0].stat().st_mtime_ns
+        return bool(self.dependents) and all(job.is_uptodate() and min(t.stat().st_mtime_ns for t in job.targets)
+                                             >= encrypted for job in self.dependents)
+
+    def execute(self, runner: "Runner") -> str:
+        if runner.passphrase is None:
+            logging.error(f"Could not decrypt {self.inputs[0]}: please specify the passphrase with --passphrase")
+            return "failed"
+        result = runner.compendium.decrypt_file_task(runner.passphrase, self.inputs[0], self.targets[0])
+        if result is not None:  # TaskFailed
+            logging.error(f"Could not decrypt {self.inputs[0]}: {result.message}")
+            return "failed"
+        # give the plaintext the time of the encrypted file, so decrypting again does not make the scripts out of date
+        stat = self.inputs[0].stat()
+        os.utime(self.targets[0], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        return "ok"
+
+
+class InstallJob(Job):
+    """Install the python environment"""
+    kind = "install"
+
+    def __init__(self, compendium: Compendium):
+        super().__init__("install:python", [compendium.pyenv], [])
+        self.compendium = compendium
+
+    def is_uptodate(self) -> bool:
+        # like the doit install task, the environment is installed again if the requirements changed
+        return self.compendium.python_env_uptodate()
+
+    def execute(self, runner: "Runner") -> str:
+        try:
+            runner.compendium.install_python_task()
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Installing the python environment failed with exit code {e.returncode}")
+            return "failed"
+        return "ok"
+
+
+class Runner:
+    def __init__(self, compendium: Compendium, jobs: int = 1, force=False, cpus: int = None, memory: int = None,
+                 passphrase: str = None, trace: Path = None, fuse=False, tmp_private=False):
+        self.compendium = compendium
+        self.workers = jobs
+        self.force = force
+        self.cpus = cpus or os.cpu_count()
+        self.memory = memory or total_memory()
+        self.passphrase = passphrase
+        self.trace = trace
+        self.fuse = fuse
+        self.tmp_private = tmp_private
+        self.runlog = RunLog(compendium.folders.STATE / RUNLOG)
+        self.jobs = build_graph(get_jobs(compendium))
+        stream_private(self.jobs)
+
+    def environment(self, job: ActionJob) -> Dict[str, str]:
+        """
+        Get the environment of a script. The thread variables are set to its #THREADS, or if it has no #THREADS
+        header and several workers share the cpus, to its share of the cpus
+        """
+        if "THREADS" in job.action.headers:
+            threads = job.threads
+        elif self.workers > 1:
+            threads = max(1, self.cpus // self.workers)
+        else:
+            return dict(os.environ)
+        return dict(os.environ, **{var: str(threads) for var in THREAD_VARIABLES})
+
+    def get_key(self) -> bytes:
+        """Get the key to decrypt private files (raising ValueError if no passphrase was given)"""
+        if self.passphrase is None:
+            raise ValueError("please specify the passphrase with --passphrase")
+        return self.compendium.get_key(self.passphrase)
+
+    def select(self, names: Iterable[str]) -> List[Job]:
+        """Get the jobs needed for the given script names or target files (and all jobs they depend on)"""
+        by_name: Dict[str, List[Job]] = {}  # a FOREACH script has a job for each shard
+        for job in self.jobs:
+            keys = [job.name] + [str(target) for target in job.targets]
+            if isinstance(job, ActionJob):
+                keys += [job.action.name.split("[")[0], job.action.file.name]
+            for key in set(keys):
+                by_name.setdefault(key, []).append(job)
+        selected, todo = set(), []
+        for name in names:
+            jobs = by_name.get(name) or by_name.get(str(Path(name).absolute()))
+            if jobs is None:
+                raise ValueError(f"No script or target {name}")
+            todo += jobs
+        while todo:
+            job = todo.pop()
+            if job not in selected:
+                selected.add(job)
+                todo += job.deps
+        return [job for job in self.jobs if job in selected]
+
+    def run(self, jobs: List[Job] = None) -> bool:
+        """
+        Run the jobs (default: all jobs, except decrypting private files that no script uses),
+        returning True if all jobs succeeded
+        """
+        if jobs is None:
+            jobs = [job for job in self.jobs if job.dependents or not isinstance(job, DecryptJob)]
+        with temporary_private_folder(self.compendium) if self.tmp_private else ExitStack():
+            return self._run(jobs)
+
+    def _run(self, jobs: List[Job]) -> bool:
+        if self.fuse:
+            jobs = fuse_pipes(jobs, self.jobs)
+        self.prioritize(jobs)
+        selected = set(jobs)
+        waiting = {job: len(job.deps & selected) for job in jobs}
+        ready = [(-job.priority, job) for (job, n) in waiting.items() if n == 0]
+        heapq.heapify(ready)
+        running, failed = {}, []
+        free_cpus, free_memory = self.cpus, self.memory
+        free_lanes = list(range(self.workers))  # a heap, so each job runs on the lowest free lane in the trace
+        start = time.perf_counter()
+        logging.info(f"Running {len(jobs)} job(s) using {self.workers} worker(s), {self.cpus} CPU(s)"
+                     + (f" and {format_size(self.memory)} memory" if self.memory else ""))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while ready or running:
+                while ready and len(running) < self.workers and not failed:
+                    job = self._pop_fitting(ready, free_cpus, free_memory, alone=not running)
+                    if job is None:
+                        break
+                    free_cpus -= job.threads
+                    if free_memory is not None:
+                        free_memory -= job.memory
+                    job.lane = heapq.heappop(free_lanes)
+                    running[executor.submit(self.run_job, job)] = job
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    free_cpus += job.threads
+                    if free_memory is not None:
+                        free_memory += job.memory
+                    heapq.heappush(free_lanes, job.lane)
+                    try:
+                        job.status = future.result()
+                    except Exception:
+                        logging.exception(f"Error running {job.name}")
+                        job.status = "failed"
+                    if job.status == "failed":
+                        failed.append(job)
+                        continue
+                    for dependent in job.dependents & selected:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            heapq.heappush(ready, (-dependent.priority, dependent))
+        self.report(jobs, time.perf_counter() - start)
+        if self.trace:
+            write_trace(self.trace, jobs, start)
+        return not failed
+
+    def _pop_fitting(self, ready: list, free_cpus: int, free_memory: Optional[int], alone: bool) -> Optional[Job]:
+        """
+        Pop the highest priority job that fits in the free resources. If alone is True (nothing is running),
+        the highest priority job is always returned, even if it needs more than the total budget.
+        """
+        skipped, result = [], None
+        while ready:
+            item = heapq.heappop(ready)
+            job = item[1]
+            if alone or (job.threads <= free_cpus and (free_memory is None or job.memory <= free_memory)):
+                if job.threads > self.cpus or (self.memory is not None and job.memory > self.memory):
+                    logging.warning(f"{job.name} needs more resources than available "
+                                    f"({job.threads} threads, {format_size(job.memory)}), running it by itself")
+                result = job
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(ready, item)
+        return result
+
+    def run_job(self, job: Job) -> str:
+        """Run a single job, returning its status"""
+        # --force only runs the scripts again, not the decryption and installation
+        force = self.force and isinstance(job, (ActionJob, PipelineJob))
+        if isinstance(job, DecryptJob) and self.force:
+            # the scripts that use the file run again, so it is needed unless it was decrypted before
+            uptodate = job.targets[0].exists()
+        else:
+            uptodate = not force and job.is_uptodate()
+        if uptodate:
+            logging.debug(f"{job.name} is up to date")
+            return "uptodate"
+        logging.info(f"Running {job.name}")
+        job.start = time.perf_counter()
+        try:
+            status = job.execute(self)
+        finally:
+            job.end = time.perf_counter()
+        if not isinstance(job, (ActionJob, PipelineJob)):  # actions record their own resource usage
+            self.runlog.record(job.name, status, Usage(job.end - job.start, 0.0, 0, 0, 0))
+        return status
+
+    def prioritize(self, jobs: List[Job]):
+        """Set the priority of each job to the estimated duration of the longest path from this job to the end"""
+        durations = self.runlog.durations()
+        default = statistics.median(durations.values()) if durations else 1.0
+        for job in jobs:
+            job.duration = job.estimate(durations, default)
+        selected = set(jobs)
+        for job in reversed(jobs):  # jobs are in topological order
+            job.priority = job.duration + max((d.priority for d in job.dependents & selected), default=0)
+
+    def report(self, jobs: List[Job], seconds: float):
+        counts = {}
+        for job in jobs:
+            counts[job.status or "not started"] = counts.get(job.status or "not started", 0) + 1
+        summary = ", ".join(f"{n} {status}" for (status, n) in sorted(counts.items()))
+        logging.info(f"Finished in {seconds:.1f}s: {summary}")
+        failed = [job.name for job in jobs if job.status == "failed"]
+        if failed:
+            logging.error(f"Failed job(s): {', '.join(failed)}")
+
+
+def get_jobs(compendium: Compendium) -> List[Job]:
+    """Create the jobs to decrypt the private files, install the python environment, and run the actions"""
+    jobs: List[Job] = [DecryptJob(compendium, f) for f in compendium.encrypted_files()]
+    install = InstallJob(compendium) if compendium.pyenv else None
+    if install:
+        jobs.append(install)
+    for action in compendium.get_actions():
+        job = ActionJob(action, compendium.root)
+        if install and action.file.suffix == ".py":
+            job.deps.add(install)
+            install.dependents.add(job)
+        jobs.append(job)
+    return jobs
+
+
+def build_graph(jobs: List[Job]) -> List[Job]:
+    """Link the jobs by their inputs and targets, returning them in topological order"""
+    producers: Dict[Path, Job] = {}
+    for job in jobs:
+        for target in job.targets:
+            if target in producers:
+                raise ValueError(f"File {target} is produced by multiple scripts: {producers[target].name}, "
+                                 f"{job.name}, use compendium check for details")
+            producers[target] = job
+    for job in jobs:
+        for input in job.inputs:
+            producer = producers.get(input)
+            if producer is not None and producer is not job:
+                job.deps.add(producer)
+                producer.dependents.add(job)
+    # Kahn's algorithm for topological sorting
+    ndeps = {job: len(job.deps) for job in jobs}
+    queue = [job for job in jobs if not job.deps]
+    result = []
+    while queue:
+        job = queue.pop()
+        result.append(job)
+        for dependent in job.dependents:
+            ndeps[dependent] -= 1
+            if ndeps[dependent] == 0:
+                queue.append(dependent)
+    if len(result) != len(jobs):
+        cyclic = sorted(job.name for job in jobs if ndeps[job] > 0)
+        raise ValueError(f"Cyclical dependencies between {', '.join(cyclic)}, use compendium check for details")
+    return result
+
+
+def fuse_pipes(jobs: List[Job], graph: List[Job]) -> List[Job]:
+    """
+    Replace chains of PIPE actions in jobs by pipeline jobs. An action is fused with the next action if its target
+    is not marked with #KEEP and is only used (in the whole graph) as the input of that action.
+    The links of the jobs in the graph are updated. Returns the jobs in topological order
+    """
+    consumers: Dict[Path, List[Job]] = {}
+    for job in graph:
+        for input in job.inputs:
+            consumers.setdefault(input, []).append(job)
+    selected = set(jobs)
+    chains: Dict[Job, List[ActionJob]] = {}  # the chain that ends in each job
+    for job in jobs:  # in topological order, so the chain of the producer is complete
+        if not (_is_pipe(job) and job.inputs):
+            continue
+        producer = next((d for d in job.deps if job.inputs[0] in d.targets), None)
+        if (producer in selected and _is_pipe(producer) and consumers[job.inputs[0]] == [job]
+                and producer.action.headers.get("KEEP", "F")[0].lower() != "t"):
+            chains[job] = chains.pop(producer, [producer]) + [job]
+    fused = {stage: chain for chain in chains.values() for stage in chain[:-1]}
+    result = []
+    for job in jobs:
+        if job in fused:
+            continue
+        if job not in chains:
+            result.append(job)
+            continue
+        pipeline = PipelineJob(chains[job])
+        for stage in pipeline.stages:
+            for dep in stage.deps - set(pipeline.stages):
+                dep.dependents.discard(stage)
+                dep.dependents.add(pipeline)
+                pipeline.deps.add(dep)
+            for dependent in stage.dependents - set(pipeline.stages):
+                dependent.deps.discard(stage)
+                dependent.deps.add(pipeline)
+                pipeline.dependents.add(dependent)
+        logging.debug(f"Fused {pipeline.name} into a single pipeline")
+        result.append(pipeline)
+    return result
+
+
+def stream_private(jobs: List[Job]):
+    """
+    Let PIPE actions decrypt their private input straight into stdin if it was not decrypted yet, rather than
+    waiting for a decrypt job that writes the plaintext to disk
+    """
+    for job in jobs:
+        if isinstance(job, DecryptJob) and not job.targets[0].exists():
+            for dependent in [d for d in job.dependents if _is_pipe(d)]:
+                dependent.encrypted = job.inputs[0]
+                dependent.deps.discard(job)
+                job.dependents.discard(dependent)
+
+
+def _is_pipe(job: Job) -> bool:
+    return isinstance(job, ActionJob) and job.action.command is not None
+
+
+@contextmanager
+def temporary_private_folder(compendium: Compendium):
+    """
+    Link the private data folder to a temporary folder (in memory if /dev/shm is available), so the decrypted files
+    are never written to disk. The temporary folder and its contents are removed afterwards, and the private data
+    folder is left empty
+    """
+    link = compendium.folders.DATA_PRIVATE
+    if link.is_symlink():  # left behind by an interrupted run
+        if link.resolve().name.startswith(TMP_PREFIX):
+            shutil.rmtree(link.resolve(), ignore_errors=True)
+        link.unlink()
+    elif link.is_dir() and not any(link.iterdir()):
+        link.rmdir()
+    elif link.exists():
+        raise ValueError(f"{link} already exists, cannot decrypt the private files to a temporary folder")
+    folder = tempfile.mkdtemp(prefix=TMP_PREFIX, dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    logging.info(f"Decrypting private files to temporary folder {folder}")
+    link.symlink_to(folder, target_is_directory=True)
+    try:
+        yield
+    finally:
+        link.unlink()
+        shutil.rmtree(folder, ignore_errors=True)
+        link.mkdir()  # restore the (empty) folder of the compendium layout
+
+
+def write_trace(file: Path, jobs: Iterable[Job], start: float):
+    """Write the jobs that were run as spans on their worker lanes, in the (chrome) trace event format"""
+    events, lanes = [], set()
+    for job in jobs:
+        if job.start is None:
+            continue
+        lanes.add(job.lane)
+        events.append(dict(name=job.name, cat=job.kind, ph="X", pid=1, tid=job.lane,
+                           ts=round((job.start - start) * 1e6), dur=round((job.end - job.start) * 1e6),
+                           args=dict(status=job.status, threads=job.threads, memory=job.memory)))
+    for lane in sorted(lanes):
+        events.append(dict(name="thread_name", ph="M", pid=1, tid=lane, args=dict(name=f"worker {lane}")))
+    events.append(dict(name="process_name", ph="M", pid=1, tid=0, args=dict(name="compendium run")))
+    with open(file, "w") as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+    logging.info(f"Wrote trace of {len(events) - len(lanes) - 1} job(s) to {file}")
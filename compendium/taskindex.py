@@ -0,0 +1,105 @@
+"""
+On-disk cache of the actions and encrypted files of a compendium, so `doit` does not parse the scripts again if
+nothing changed
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Tuple, Dict, Optional, Iterable
+
+from compendium.action import Action
+from compendium.util import write_json
+
+INDEX_VERSION = 1
+
+
+def _scan(folder: str, files: bool, result: Dict[str, int]):
+    """Add the modification time of folder and its subfolders (and files, if files is True) to result"""
+    try:
+        result[folder] = os.stat(folder).st_mtime_ns
+        entries = list(os.scandir(folder))
+    except (FileNotFoundError, NotADirectoryError):
+        result[folder] = None
+        return
+    for entry in entries:
+        if entry.name.startswith(".") or entry.name == "__pycache__":
+            continue
+        if entry.is_dir():
+            _scan(entry.path, files, result)
+        elif files:
+            result[entry.path] = entry.stat().st_mtime_ns
+
+
+def _to_json(action: Action) -> list:
+    return [str(action.file), action.action, [str(f) for f in action.targets], [str(f) for f in action.inputs],
+            action.headers, action.name, action.command, list(action.codecs)]
+
+
+def _from_json(data: list) -> Action:
+    file, action, targets, inputs, headers, name, command, codecs = data
+    return Action(Path(file), action, [Path(f) for f in targets], [Path(f) for f in inputs], headers, name, command,
+                  tuple(codecs))
+
+
+class TaskIndex:
+    """
+    Cache of the actions and encrypted files, invalidated by the modification times of the configuration file,
+    the scripts and source folders, and the folders of the encrypted files and FOREACH inputs (adding or removing
+    a file changes the modification time of its folder)
+    """
+
+    def __init__(self, file: Path, root: Path, config: Path, sources: Iterable[Path], folders: Iterable[Path]):
+        self.file = file
+        self.root = root
+        self.config = config
+        self.sources = [str(f) for f in sources]
+        self.folders = [str(f) for f in folders]
+
+    def stamp(self, watched: Iterable[str] = ()) -> Dict[str, int]:
+        """Get the modification times of the configuration file, the source files and folders, and the folders"""
+        result = {}
+        try:
+            result[str(self.config)] = os.stat(self.config).st_mtime_ns
+        except FileNotFoundError:
+            result[str(self.config)] = None
+        for folder in self.sources:
+            _scan(folder, True, result)
+        for folder in list(self.folders) + list(watched):
+            _scan(folder, False, result)
+        return result
+
+    def load(self) -> Optional[Tuple[List[Action], List[Path]]]:
+        """Get the cached actions and encrypted files, or None if the index is missing or out of date"""
+        try:
+            with self.file.open() as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION or data["root"] != str(self.root):
+                return None
+            if data["stamp"] != self.stamp(data["watched"]):
+                logging.debug(f"Task index {self.file} is out of date")
+                return None
+            return [_from_json(a) for a in data["actions"]], [Path(f) for f in data["encrypted"]]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug(f"Ignoring unreadable task index {self.file}: {e}")
+            return None
+
+    def save(self, stamp: Dict[str, int], watched: Iterable[Path], actions: List[Action], encrypted: List[Path]):
+        """
+        Save the actions and encrypted files. The stamp should be taken before they were collected, so a file that
+        changes while they are collected invalidates the index. watched are the extra folders the actions depend on
+        """
+        watched = sorted({str(f) for f in watched})
+        full = {}
+        for folder in watched:  # only scan the watched folders, the rest was scanned before collecting
+            _scan(folder, False, full)
+        full.update(stamp)  # keep the times from before collecting
+        data = {"version": INDEX_VERSION, "root": str(self.root), "stamp": full, "watched": watched,
+                "actions": [_to_json(a) for a in actions], "encrypted": [str(f) for f in encrypted]}
+        logging.debug(f"Writing task index {self.file}")
+        try:
+            write_json(self.file, data)
+        except OSError as e:
+            logging.debug(f"Could not write task index {self.file}: {e}")
@@ -0,0 +1,192 @@
+"""
+Log of action runs with their resource usage, used to find slow scripts and to estimate durations when scheduling
+"""
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+from compendium import instrument
+
+RUNLOG = "runs.jsonl"
+
+
+class Usage(NamedTuple):
+    wall: float  # seconds
+    cpu: float  # user + system seconds, including child processes
+    max_rss: int  # bytes, of the largest process
+    read_bytes: int  # from storage (i.e. not counting the page cache)
+    write_bytes: int
+
+    def asdict(self) -> dict:
+        return dict(wall=round(self.wall, 3), cpu=round(self.cpu, 3), max_rss=self.max_rss,
+                    read_bytes=self.read_bytes, write_bytes=self.write_bytes)
+
+    def combine(self, other: "Usage") -> "Usage":
+        """Total usage of two processes that ran at the same time"""
+        return Usage(max(self.wall, other.wall), self.cpu + other.cpu, max(self.max_rss, other.max_rss),
+                     self.read_bytes + other.read_bytes, self.write_bytes + other.write_bytes)
+
+
+# The commands are started by a small wrapper process that reports the resource usage of the command through a pipe.
+# A process inherits the peak memory use (ru_maxrss) of the process it was forked from, so measuring the commands
+# directly would report at least the memory use of this (possibly large) python process
+_WRAPPER = """
+import os, signal, sys
+fd = int(sys.argv[2])
+os.set_inheritable(fd, False)
+pid = os.posix_spawn("/bin/sh", ["/bin/sh", "-c", sys.argv[1]], os.environ,
+                     setsigdef=(signal.SIGPIPE, signal.SIGXFSZ, signal.SIGINT))
+signal.signal(signal.SIGINT, signal.SIG_IGN)  # the command handles ctrl-c, so we can report its usage
+_, status, ru = os.wait4(pid, 0)
+os.write(fd, f"{status} {ru.ru_utime + ru.ru_stime} {ru.ru_maxrss} {ru.ru_inblock} {ru.ru_oublock}".encode())
+sys.exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status))
+"""
+
+
+def _start(cmd: str, **kargs) -> Tuple[subprocess.Popen, Optional[int]]:
+    """Start the shell command (using the wrapper if possible), returning the process and the usage report pipe"""
+    if not hasattr(os, "posix_spawn"):  # e.g. windows
+        return subprocess.Popen(cmd, shell=True, **kargs), None
+    read, write = os.pipe()
+    try:
+        proc = subprocess.Popen([sys.executable, "-S", "-c", _WRAPPER, cmd, str(write)], pass_fds=(write,), **kargs)
+    except BaseException:
+        os.close(read)
+        raise
+    finally:
+        os.close(write)
+    return proc, read
+
+
+def run_measured(cmd: str, cwd: Path = None, env: Dict[str, str] = None) -> Tuple[int, Usage]:
+    """Run a shell command, returning its exit code and resource usage"""
+    logging.debug(cmd)
+    start = time.perf_counter()
+    returncode, usage = _wait_measured(*_start(cmd, cwd=cwd, env=env), start)
+    instrument.add("subprocess", usage.wall)
+    return returncode, usage
+
+
+def run_pipeline(cmds: List[str], stdin: Union[Path, Iterable[bytes], None], stdout: Path, cwd: Path = None,
+                 envs: List[Dict[str, str]] = None) -> Tuple[List[int], List[Usage]]:
+    """
+    Run shell commands connected by pipes, writing stdout to the given file. Stdin is read from the given file, or
+    fed from an iterable of chunks (e.g. a stream that is decrypted on the fly). Returns the exit code and resource
+    usage of each command, or raises the exception raised by the stdin iterable
+    """
+    logging.debug(" | ".join(cmds))
+    start = time.perf_counter()
+    procs, feeder, errors = [], None, []
+    with ExitStack() as files:
+        source = files.enter_context(open(stdin, "rb")) if isinstance(stdin, Path) else None
+        target = files.enter_context(open(stdout, "wb"))
+        for i, cmd in enumerate(cmds):
+            last = i == len(cmds) - 1
+            pipe_in = i == 0 and stdin is not None and source is None
+            proc, report = _start(cmd, cwd=cwd, env=envs[i] if envs else None,
+                                  stdin=subprocess.PIPE if pipe_in else source,
+                                  stdout=target if last else subprocess.PIPE)
+            if pipe_in:
+                feeder = threading.Thread(target=_feed, args=(stdin, proc.stdin, errors), daemon=True)
+                feeder.start()
+            if procs:
+                source.close()  # so the previous command gets SIGPIPE if this command exits early
+            source = proc.stdout
+            procs.append((proc, report))
+    results = [_wait_measured(proc, report, start) for (proc, report) in procs]
+    if feeder:
+        feeder.join()
+    instrument.add("subprocess", time.perf_counter() - start)
+    if errors:
+        raise errors[0]
+    return [r[0] for r in results], [r[1] for r in results]
+
+
+def _feed(chunks: Iterable[bytes], pipe: BinaryIO, errors: list):
+    """Write the chunks to the pipe and close it, storing any exception (except a closed pipe) in errors"""
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except BrokenPipeError:
+        pass  # the command exited without reading all input, which is reported by its exit code
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _wait_measured(proc: subprocess.Popen, report: Optional[int], start: float) -> Tuple[int, Usage]:
+    """Wait for the process to finish, returning its exit code and the resource usage reported by the wrapper"""
+    returncode = proc.wait()
+    wall = time.perf_counter() - start
+    if report is None:
+        return returncode, Usage(wall, 0.0, 0, 0, 0)
+    with open(report, "rb") as f:
+        data = f.read().split()
+    if not data:  # the wrapper failed (or was killed)
+        return returncode, Usage(wall, 0.0, 0, 0, 0)
+    status, cpu, max_rss, inblock, oublock = int(data[0]), float(data[1]), int(data[2]), int(data[3]), int(data[4])
+    # report a command killed by a signal like subprocess does, rather than the exit code of the wrapper
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return returncode, Usage(wall, cpu, max_rss * rss_unit, inblock * 512, oublock * 512)
+
+
+class RunLog:
+    """Append-only JSON-lines log of action runs"""
+
+    def __init__(self, file: Path):
+        self.file = file
+
+    def record(self, name: str, status: str, usage: Usage):
+        record = dict(name=name, time=time.time(), status=status, **usage.asdict())
+        try:
+            self.file.parent.mkdir(exist_ok=True)
+            with self.file.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logging.debug(f"Could not write run log {self.file}: {e}")
+
+    def records(self) -> List[dict]:
+        if not self.file.exists():
+            return []
+        result = []
+        with self.file.open() as f:
+            for line in f:
+                try:
+                    result.append(json.loads(line))
+                except ValueError:
+                    continue
+        return result
+
+    def durations(self, last: int = 5) -> Dict[str, float]:
+        """Estimated duration of each action: the median wall time of its last successful runs"""
+        return {name: statistics.median(r["wall"] for r in runs[-last:]) for (name, runs) in self.history().items()}
+
+    def history(self) -> Dict[str, List[dict]]:
+        """Successful runs per action, oldest first"""
+        result = defaultdict(list)
+        for record in self.records():
+            if record.get("status") == "ok":
+                result[record["name"]].append(record)
+        return result
+
+
+def regression(runs: List[dict], last: int = 5) -> float:
+    """Ratio of the wall time of the latest run to the median of the (up to last) runs before it"""
+    if len(runs) < 2:
+        return 1.0
+    previous = statistics.median(r["wall"] for r in runs[-last-1:-1])
+    return runs[-1]["wall"] / previous if previous > 0 else 1.0
@@ -1,19 +1,67 @@
+import itertools
+import json
 import logging
+import os
 import re
 import subprocess
+import tempfile
+from fnmatch import fnmatch
 from pathlib import Path
-from typing import List, Iterable, Tuple
+from typing import List, Iterable, Tuple, Sequence, Iterator, Dict, Optional
 
 
-def get_files(folder: Path, suffix=None) -> List[Path]:
-    """Get all files contained in Path (optionally filtering for suffix)"""
-    if isinstance(suffix, str):
-        suffix = [suffix]
+def get_files(folder: Path, suffix=None, include: Sequence[str] = None, exclude: Sequence[str] = None) -> List[Path]:
+    """Get all files contained in Path and its subfolders (optionally filtering for suffix, see walk_files)"""
     path = Path.cwd() / folder
     if not path.is_dir():
         logging.warning(f"{path} does not exist or is not a directory")
         return []
-    return [f for f in path.iterdir() if (f.is_file() and ((suffix is None) or (f.suffix in suffix)))]
+    return [Path(entry.path) for entry in walk_files(path, suffix, include, exclude)]
+
+
+def walk_files(folder: Path, suffix=None, include: Sequence[str] = None, exclude: Sequence[str] = None,
+               hidden=False) -> Iterator[os.DirEntry]:
+    """
+    Recursively yield the files in folder as os.DirEntry objects, which cache their stat results.
+    include and exclude are glob patterns matched against the path relative to folder, e.g. 'old/*' or '*.bak'.
+    Excluded folders are not scanned. Hidden files and folders are skipped unless hidden is True.
+    Symbolic links to folders are followed, but every folder is only scanned once (so links to a parent folder do
+    not loop). Folders that cannot be read are skipped with a warning.
+    """
+    if isinstance(suffix, str):
+        suffix = [suffix]
+    exclude = exclude or []
+    folders = [(str(folder), "")]
+    visited = set()
+    while folders:
+        path, prefix = folders.pop()
+        try:
+            stat = os.stat(path)
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        except OSError as e:
+            logging.warning(f"Skipping {path}: {e}")
+            continue
+        subfolders = []
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.name.startswith(".") and not hidden:
+                continue
+            relative = f"{prefix}{entry.name}"
+            if any(fnmatch(relative, pattern) for pattern in exclude):
+                continue
+            if entry.is_dir():
+                subfolders.append((entry.path, f"{relative}/"))
+            elif entry.is_file():
+                if suffix is not None and os.path.splitext(entry.name)[1] not in suffix:
+                    continue
+                if include and not any(fnmatch(relative, pattern) for pattern in include):
+                    continue
+                yield entry
+        folders.extend(reversed(subfolders))
 
 
 def contained_in(parent: Path, descendant: Path) -> bool:
@@ -23,18 +71,41 @@ def contained_in(parent: Path, descendant: Path) -> bool:
     return str(descendant.absolute()).startswith(f"{parent}{os.path.sep}")
 
 
+_HEADER = re.compile(r"#(\w+?):(.*)")
+
+
+def write_json(file: Path, data):
+    """
+    Write data to file as json, atomically: it is written to a unique temporary file in the same folder, which then
+    replaces file, so several threads or processes can write the file at the same time. Raises OSError on failure
+    """
+    file.parent.mkdir(exist_ok=True)
+    f = tempfile.NamedTemporaryFile("w", dir=file.parent, prefix=f".{file.name}.", suffix=".tmp", delete=False)
+    try:
+        with f:
+            json.dump(data, f)
+        os.replace(f.name, file)
+    except BaseException:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+
+
 def get_headers(file: Path) -> Iterable[Tuple[str, str]]:
     """Get [#! command] and [#key: value] headers from a file"""
-    for i, line in enumerate(file.open()):
-        if not line.strip():
-            continue
-        if not line.startswith("#"):
-            break
-        if i == 0 and line.startswith("#!"):
-            yield "COMMAND", line[2:].strip()
-        m = re.match(r"#(\w+?):(.*)", line)
-        if m:
-            yield m.groups()[0].strip(), m.groups()[1].strip()
+    with file.open() as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            if not line.startswith("#"):
+                break
+            if i == 0 and line.startswith("#!"):
+                yield "COMMAND", line[2:].strip()
+            m = _HEADER.match(line)
+            if m:
+                yield m.groups()[0].strip(), m.groups()[1].strip()
 
 
 def parse_files(text: str) -> List[Path]:
@@ -44,6 +115,37 @@ def parse_files(text: str) -> List[Path]:
     return [Path(x.strip()) for x in re.split("[ ,]+", text)]
 
 
+def glob_base(pattern: str) -> Path:
+    """Get the folder part of a glob pattern, i.e. the folder that contains all matching files"""
+    return Path(*itertools.takewhile(lambda part: not any(c in part for c in "*?["), Path(pattern).parts))
+
+
+def parse_foreach(text: str, root: Path) -> List[Tuple[Path, Path, str]]:
+    """
+    Expand a FOREACH header (pattern -> target) to an (input, target, key) tuple for each file in root matching the
+    pattern. The target can use the {stem} and {name} of the input file. The key identifies the input file: its path
+    relative to the folder part of the pattern
+    """
+    pattern, sep, template = (x.strip() for x in text.partition("->"))
+    if not (pattern and sep and template):
+        raise ValueError(f"Invalid FOREACH {text!r}, use pattern -> target, "
+                         "e.g. data/raw/news/*.json -> data/intermediate/news/{stem}.csv")
+    if "{stem}" not in template and "{name}" not in template:
+        raise ValueError(f"FOREACH target {template} should contain {{stem}} or {{name}}")
+    base = glob_base(pattern)
+    result = []
+    for file in sorted(root.glob(pattern)):
+        if not file.is_file() or file.name.startswith("."):
+            continue
+        try:
+            target = Path(template.format(stem=file.stem, name=file.name))
+        except (KeyError, IndexError) as e:
+            raise ValueError(f"Unknown field {e} in FOREACH target {template}, use {{stem}} or {{name}}")
+        input = file.relative_to(root)
+        result.append((input, target, input.relative_to(base).as_posix()))
+    return result
+
+
 def AbsolutePath(*args, **kargs) -> Path:
     """Create an absolute path (useful as argument 'type')"""
     return Path(*args, **kargs).absolute()
@@ -70,7 +172,42 @@ def yesno(prompt, default: bool = None, add_options=True) -> bool:
     return yesno(prompt, default, add_options=False)
 
 
-def call(cmd: str):
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as '512M' or '20G' (binary units) to a number of bytes"""
+    m = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)i?B?\s*", text, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Cannot parse size: {text}")
+    return int(float(m.group(1)) * _UNITS[m.group(2).upper()])
+
+
+def format_size(nbytes: int) -> str:
+    """Format a number of bytes as e.g. '1.5G'"""
+    for unit in ["", "K", "M", "G"]:
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f}{unit}" if unit else f"{nbytes}B"
+        nbytes /= 1024
+    return f"{nbytes:.1f}T"
+
+
+def format_throughput(nbytes: int, seconds: float) -> str:
+    """Describe the amount of data processed and the speed, e.g. '12.0 MB in 1.5s (8.0 MB/s)'"""
+    mb = nbytes / 1e6
+    speed = mb / seconds if seconds > 0 else float("inf")
+    return f"{mb:.1f} MB in {seconds:.1f}s ({speed:.1f} MB/s)"
+
+
+def call(cmd: str, cwd: Path = None, env: Dict[str, str] = None):
     """Print and call a system command"""
     logging.debug(cmd)
-    subprocess.check_call(cmd, shell=True)
\ No newline at end of file
+    subprocess.check_call(cmd, shell=True, cwd=cwd, env=env)
+
+
+def total_memory() -> Optional[int]:
+    """Total physical memory in bytes (if it can be determined)"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
\ No newline at end of file
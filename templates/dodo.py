@@ -16,19 +16,25 @@ from typing import Iterable, List, Tuple, Optional, NamedTuple, Dict
 
 from doit.action import CmdAction
 from doit import get_var
-from doit.tools import run_once
 
-from compendium.compendium import Compendium
+from compendium.compendium import get_compendium
+
+# The tasks share one Compendium, which gets the scripts and encrypted files from the task index in .compendium
+# if no source folder or the configuration changed, so `doit list` and no-op runs do not parse all scripts
+
+# By default, only decrypt the private files that are needed by the processing scripts (use `doit decrypt` for all)
+DOIT_CONFIG = {'default_tasks': ['install', 'process']}
 
 
 def task_install():
     """Install python/R dependencies as needed"""
-    compendium = Compendium()
+    compendium = get_compendium()
     if compendium.pyenv:
         yield {
             'name': f"Install python environment and dependencies",
             'targets': [compendium.pyenv],
-            'uptodate': [run_once],
+            # up to date if it was installed for the current requirements (see compendium.initsegment.pyenv)
+            'uptodate': [compendium.python_env_uptodate],
             'actions': [compendium.install_python_task],
             'verbosity': 2
         }
@@ -37,13 +43,17 @@ def task_install():
 def task_decrypt():
     """Decrypt private files from raw-private-encrypted (provide passphrase with `doit passphrase="Your secret"`)"""
     passphrase = get_var('passphrase')
-    compendium = Compendium()
-    files = list(compendium.folders.DATA_ENCRYPTED.glob("*"))
+    compendium = get_compendium()
+    files = compendium.encrypted_files(cached=True)
+    if passphrase and any(not compendium.decrypted_path(inf).exists() for inf in files):
+        # Derive the key before doit starts any (forked) workers, so it is not derived again for each file
+        compendium.get_key(passphrase)
     for inf in files:
-        outf = compendium.folders.DATA_PRIVATE/inf.name
+        outf = compendium.decrypted_path(inf)
         yield {
             'name': outf,
-            'targets': [outf],
+            # relative to the root, like the file_dep of the processing tasks, so doit links them
+            'targets': [outf.relative_to(compendium.root)],
             'actions': [(compendium.decrypt_file_task, (passphrase, inf, outf))],
             'uptodate': [outf.exists]
         }
@@ -51,12 +61,16 @@ def task_decrypt():
 
 def task_process():
     """Create tasks for the processing scripts in src/data-processing"""
-    compendium = Compendium()
-    for action in compendium.get_actions():
+    compendium = get_compendium()
+    actions = compendium.get_actions()
+    yield dict(basename="process", actions=None, task_dep=[f"process:{action.name}" for action in actions],
+               doc="Run all processing scripts")
+    for action in actions:
         result = dict(
-            basename=f"process:{action.file.name}",
+            basename=f"process:{action.name}",
             targets=action.targets,
-            actions=[action.action],
+            # run_action_task records the resource usage and uses the artifact cache (if configured)
+            actions=[(compendium.run_action_task, (action,))],
         )
         if 'DESCRIPTION' in action.headers:
             result['doc'] = action.headers['DESCRIPTION']